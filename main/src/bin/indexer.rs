@@ -3,21 +3,27 @@
 // Run with: cargo run --bin indexer
 
 use dotenv::dotenv;
-use tracing_subscriber;
 use tracing::{info, error};
 use std::sync::Arc;
-use warp::Filter;
-use tokio::sync::Mutex;
+use tokio::sync::Semaphore;
 use rdkafka::consumer::{Consumer, StreamConsumer};
+use rdkafka::message::BorrowedMessage;
 use rdkafka::{ClientConfig, Message};
+use std::time::Duration;
 use Quiry::{
     config::Config, 
     kafka_types::{DISCORD_MESSAGES_TOPIC, KafkaMessage, KafkaPayload}, 
     elasticsearch::ElasticsearchClient,
+    schema::MessageEvent,
     metrics::MetricsRegistry,
     health::HealthChecker,
+    server::routes,
 };
 
+const INDEX_BATCH_SIZE: usize = 500;
+const INDEX_BATCH_WAIT: Duration = Duration::from_millis(100);
+const MAX_CONCURRENT_BULK_REQUESTS: usize = 4;
+
 #[tokio::main]
 async fn main() -> Result<(), Box<dyn std::error::Error + Send + Sync>> {
     dotenv().ok();
@@ -31,7 +37,14 @@ async fn main() -> Result<(), Box<dyn std::error::Error + Send + Sync>> {
     info!("Starting ElasticSearch Indexer Worker on port {}...", port);
     
     // Initialize ElasticSearch client
-    let es_client = Arc::new(Mutex::new(ElasticsearchClient::new(&cfg).await?));
+    let es_client = Arc::new(ElasticsearchClient::new(&cfg).await?);
+    let bulk_permits = Arc::new(Semaphore::new(MAX_CONCURRENT_BULK_REQUESTS));
+
+    // A previous run may have stopped mid-backlog with refreshes paused; restore them so
+    // newly indexed messages become searchable regardless of how this run starts
+    if let Err(e) = es_client.set_refresh_interval(None).await {
+        error!("Failed to reset refresh interval: {}", e);
+    }
     
     // Initialize Kafka consumer
     let consumer: StreamConsumer = ClientConfig::new()
@@ -50,51 +63,86 @@ async fn main() -> Result<(), Box<dyn std::error::Error + Send + Sync>> {
     info!("Indexer subscribed to topics. Starting to consume and index messages...");
     
     // Start metrics server
-    let metrics_route = warp::path("metrics")
-        .and(warp::get())
-        .and(with_metrics(metrics_registry.clone()))
-        .and_then(handle_metrics);
-
-    let health_route = warp::path("health")
-        .and(warp::get())
-        .and(with_health_checker(health_checker.clone()))
-        .and(with_config(cfg.clone()))
-        .and_then(handle_health);
-
-    let root_route = warp::path::end()
-        .and(warp::get())
-        .map(|| "Quiry Indexer Service - /metrics, /health");
-
-    let routes = metrics_route.or(health_route).or(root_route);
+    let routes = routes(
+        "Quiry Indexer Service - /metrics, /health",
+        metrics_registry,
+        health_checker,
+        cfg,
+    );
     
     // Start HTTP server in background
     let server = tokio::spawn(async move {
         warp::serve(routes).run(([0, 0, 0, 0], port)).await;
     });
     
-    // Start consuming and indexing messages
+    // Start consuming and indexing messages in bulk batches
     let indexer = tokio::spawn(async move {
+        let mut batch: Vec<MessageEvent> = Vec::with_capacity(INDEX_BATCH_SIZE);
+        let mut bulk_loading = false;
         loop {
+            // Block for the first message, then drain whatever else arrives shortly after
             match consumer.recv().await {
                 Ok(message) => {
-                    if let Some(payload) = message.payload() {
-                        match serde_json::from_slice::<KafkaMessage>(payload) {
-                            Ok(kafka_msg) => {
-                                if let KafkaPayload::DiscordMessage(msg_event) = kafka_msg.payload {
-                                    info!(message_id = %msg_event.id, "Indexing message to ElasticSearch");
-                                    
-                                    let es = es_client.lock().await;
-                                    if let Err(e) = es.index_message(&msg_event).await {
-                                        error!(message_id = %msg_event.id, "Failed to index message: {}", e);
-                                    }
-                                }
-                            }
-                            Err(e) => error!("Failed to deserialize Kafka message: {}", e),
+                    if let Some(msg_event) = decode_message(&message) {
+                        batch.push(msg_event);
+                    }
+                }
+                Err(e) => {
+                    error!("Error receiving message from Kafka: {}", e);
+                    continue;
+                }
+            }
+
+            while batch.len() < INDEX_BATCH_SIZE {
+                match tokio::time::timeout(INDEX_BATCH_WAIT, consumer.recv()).await {
+                    Ok(Ok(message)) => {
+                        if let Some(msg_event) = decode_message(&message) {
+                            batch.push(msg_event);
                         }
                     }
+                    Ok(Err(e)) => error!("Error receiving message from Kafka: {}", e),
+                    Err(_) => break,
                 }
-                Err(e) => error!("Error receiving message from Kafka: {}", e),
             }
+
+            if batch.is_empty() {
+                continue;
+            }
+
+            info!(count = batch.len(), "Indexing batch to ElasticSearch");
+
+            // A full batch means we are catching up on a backlog, so pause index refreshes
+            // until we are caught up
+            let backlog = batch.len() >= INDEX_BATCH_SIZE;
+            if backlog != bulk_loading {
+                if !backlog {
+                    // Let the backlog's in-flight bulk requests finish first, so refreshes
+                    // resume only once they are written
+                    match bulk_permits.acquire_many(MAX_CONCURRENT_BULK_REQUESTS as u32).await {
+                        Ok(all) => drop(all),
+                        Err(_) => break,
+                    }
+                }
+                let interval = if backlog { Some("-1") } else { None };
+                match es_client.set_refresh_interval(interval).await {
+                    Ok(()) => bulk_loading = backlog,
+                    Err(e) => error!("Failed to update refresh interval: {}", e),
+                }
+            }
+
+            // Let a few bulk requests run in parallel while the next batch is collected
+            let permit = match bulk_permits.clone().acquire_owned().await {
+                Ok(permit) => permit,
+                Err(_) => break,
+            };
+            let es = es_client.clone();
+            let messages = std::mem::replace(&mut batch, Vec::with_capacity(INDEX_BATCH_SIZE));
+            tokio::spawn(async move {
+                let _permit = permit;
+                if let Err(e) = es.index_messages(&messages).await {
+                    error!(count = messages.len(), "Failed to index batch: {}", e);
+                }
+            });
         }
     });
     
@@ -107,47 +155,16 @@ async fn main() -> Result<(), Box<dyn std::error::Error + Send + Sync>> {
     Ok(())
 }
 
-fn with_metrics(
-    metrics: Arc<MetricsRegistry>,
-) -> impl Filter<Extract = (Arc<MetricsRegistry>,), Error = std::convert::Infallible> + Clone {
-    warp::any().map(move || metrics.clone())
-}
-
-fn with_health_checker(
-    health_checker: Arc<HealthChecker>,
-) -> impl Filter<Extract = (Arc<HealthChecker>,), Error = std::convert::Infallible> + Clone {
-    warp::any().map(move || health_checker.clone())
-}
-
-fn with_config(
-    config: Config,
-) -> impl Filter<Extract = (Config,), Error = std::convert::Infallible> + Clone {
-    warp::any().map(move || config.clone())
-}
-
-async fn handle_metrics(metrics: Arc<MetricsRegistry>) -> Result<impl warp::Reply, warp::Rejection> {
-    let metrics_text = metrics.gather_metrics();
-    Ok(warp::reply::with_header(
-        metrics_text,
-        "Content-Type",
-        "text/plain; version=0.0.4; charset=utf-8",
-    ))
-}
-
-async fn handle_health(
-    health_checker: Arc<HealthChecker>,
-    config: Config,
-) -> Result<impl warp::Reply, warp::Rejection> {
-    let health_status = health_checker
-        .get_overall_health(&config.elasticsearch_url, &config.pinecone_host)
-        .await;
-    
-    let json_response = serde_json::to_string_pretty(&health_status)
-        .unwrap_or_else(|_| "{\"error\": \"Failed to serialize health status\"}".to_string());
-    
-    Ok(warp::reply::with_header(
-        json_response,
-        "Content-Type",
-        "application/json",
-    ))
+fn decode_message(message: &BorrowedMessage<'_>) -> Option<MessageEvent> {
+    let payload = message.payload()?;
+    match serde_json::from_slice::<KafkaMessage>(payload) {
+        Ok(kafka_msg) => match kafka_msg.payload {
+            KafkaPayload::DiscordMessage(msg_event) => Some(msg_event),
+            _ => None,
+        },
+        Err(e) => {
+            error!("Failed to deserialize Kafka message: {}", e);
+            None
+        }
+    }
 }
@@ -0,0 +1,481 @@
+use std::collections::hash_map::DefaultHasher;
+use std::collections::{BTreeMap, HashMap, VecDeque};
+use std::hash::{Hash, Hasher};
+use std::time::{Duration, Instant};
+
+/// Bounded LRU cache of embeddings keyed by a SipHash fingerprint of the text.
+///
+/// Embeddings are stored as bfloat16 (the upper half of each f32), halving the memory per
+/// cached vector; the ~0.4% relative rounding error is negligible for cosine similarity.
+pub struct EmbeddingCache {
+    capacity: usize,
+    tick: u64,
+    // fingerprint -> (last used tick, bf16 embedding)
+    entries: HashMap<u64, (u64, Vec<u16>)>,
+    // last used tick -> fingerprint, oldest first
+    recency: BTreeMap<u64, u64>,
+}
+
+impl EmbeddingCache {
+    pub fn new(capacity: usize) -> Self {
+        Self {
+            capacity: capacity.max(1),
+            tick: 0,
+            entries: HashMap::with_capacity(capacity),
+            recency: BTreeMap::new(),
+        }
+    }
+
+    fn fingerprint(text: &str) -> u64 {
+        let mut hasher = DefaultHasher::new();
+        text.trim().hash(&mut hasher);
+        hasher.finish()
+    }
+
+    fn touch(&mut self, key: u64) -> Option<&(u64, Vec<u16>)> {
+        self.tick += 1;
+        let tick = self.tick;
+        let entry = self.entries.get_mut(&key)?;
+        self.recency.remove(&entry.0);
+        self.recency.insert(tick, key);
+        entry.0 = tick;
+        Some(entry)
+    }
+
+    pub fn get(&mut self, text: &str) -> Option<Vec<f32>> {
+        let key = Self::fingerprint(text);
+        self.touch(key).map(|(_, embedding)| embedding.iter().map(|&v| bf16_to_f32(v)).collect())
+    }
+
+    pub fn insert(&mut self, text: &str, embedding: Vec<f32>) {
+        let key = Self::fingerprint(text);
+        if self.touch(key).is_some() {
+            return;
+        }
+
+        // Evict the least recently used entry once full
+        if self.entries.len() >= self.capacity {
+            if let Some((_, oldest)) = self.recency.pop_first() {
+                self.entries.remove(&oldest);
+            }
+        }
+
+        self.tick += 1;
+        self.recency.insert(self.tick, key);
+        let embedding = embedding.into_iter().map(f32_to_bf16).collect();
+        self.entries.insert(key, (self.tick, embedding));
+    }
+
+    pub fn len(&self) -> usize {
+        self.entries.len()
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.entries.is_empty()
+    }
+}
+
+/// Bounded cache whose entries expire a fixed time after insertion.
+///
+/// Since every entry lives for the same TTL, insertion order is also expiry order, so a
+/// queue of insertion times is enough to expire entries and evict the oldest when full.
+pub struct TtlCache<K, V> {
+    capacity: usize,
+    ttl: Duration,
+    entries: HashMap<K, (Instant, V)>,
+    // (inserted at, key), oldest first; may hold stale entries for keys since re-inserted
+    order: VecDeque<(Instant, K)>,
+}
+
+impl<K: Hash + Eq + Clone, V: Clone> TtlCache<K, V> {
+    pub fn new(capacity: usize, ttl: Duration) -> Self {
+        Self {
+            capacity: capacity.max(1),
+            ttl,
+            entries: HashMap::new(),
+            order: VecDeque::new(),
+        }
+    }
+
+    pub fn get(&mut self, key: &K) -> Option<V> {
+        let (inserted_at, value) = self.entries.get(key)?;
+        if inserted_at.elapsed() < self.ttl {
+            return Some(value.clone());
+        }
+        self.entries.remove(key);
+        None
+    }
+
+    pub fn insert(&mut self, key: K, value: V) {
+        let now = Instant::now();
+        self.order.push_back((now, key.clone()));
+        self.entries.insert(key, (now, value));
+
+        while let Some((inserted_at, key)) = self.order.front() {
+            let expired = now.duration_since(*inserted_at) >= self.ttl;
+            if !expired && self.entries.len() <= self.capacity {
+                break;
+            }
+            // Only drop the entry if this queue slot is its latest insertion
+            if self.entries.get(key).map_or(false, |(at, _)| at == inserted_at) {
+                self.entries.remove(key);
+            }
+            self.order.pop_front();
+        }
+    }
+
+    pub fn len(&self) -> usize {
+        self.entries.len()
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.entries.is_empty()
+    }
+}
+
+/// Per-guild content versions (None for DMs) for keying cached answers, bounded to the
+/// most recently updated guilds.
+///
+/// Versions come from one counter shared by all guilds, so a guild's version only ever
+/// increases and changes on every bump. A guild with no entry (never bumped, or evicted)
+/// reads as the highest version evicted so far, which is never lower than what it read as
+/// before, so an eviction can only cause cache misses, never a stale hit.
+pub struct GuildVersions {
+    capacity: usize,
+    next: u64,
+    floor: u64,
+    // guild -> (version, bumped at)
+    entries: HashMap<Option<String>, (u64, Instant)>,
+    // version -> guild, least recently bumped first
+    by_version: BTreeMap<u64, Option<String>>,
+}
+
+impl GuildVersions {
+    pub fn new(capacity: usize) -> Self {
+        Self {
+            capacity: capacity.max(1),
+            next: 0,
+            floor: 0,
+            entries: HashMap::new(),
+            by_version: BTreeMap::new(),
+        }
+    }
+
+    pub fn get(&self, guild_id: &Option<String>) -> u64 {
+        self.entries.get(guild_id).map_or(self.floor, |&(version, _)| version)
+    }
+
+    /// Whether the guild has gone at least `quiet` without a bump.
+    pub fn settled(&self, guild_id: &Option<String>, quiet: Duration) -> bool {
+        self.entries.get(guild_id).map_or(true, |(_, bumped_at)| bumped_at.elapsed() >= quiet)
+    }
+
+    pub fn bump(&mut self, guild_id: &Option<String>) {
+        self.next += 1;
+        let version = self.next;
+        match self.entries.get_mut(guild_id) {
+            Some(entry) => {
+                self.by_version.remove(&entry.0);
+                *entry = (version, Instant::now());
+            }
+            None => {
+                // Evict the least recently bumped guild once full
+                if self.entries.len() >= self.capacity {
+                    if let Some((evicted, oldest)) = self.by_version.pop_first() {
+                        self.entries.remove(&oldest);
+                        self.floor = self.floor.max(evicted);
+                    }
+                }
+                self.entries.insert(guild_id.clone(), (version, Instant::now()));
+            }
+        }
+        self.by_version.insert(version, guild_id.clone());
+    }
+
+    pub fn len(&self) -> usize {
+        self.entries.len()
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.entries.is_empty()
+    }
+}
+
+/// Bounded cache of responses looked up by embedding similarity, so paraphrases of a
+/// recent question can reuse its answer.
+///
+/// Lookups scan every entry in the scope, which stays cheap at the small capacities this
+/// is used with; the least recently used entry is evicted once full.
+///
+/// Stored embeddings are quantized to int8 with a per-entry scale, a quarter of the f32
+/// size, so a lookup reads 4x less memory; the query itself stays f32. Each entry's norm
+/// is folded into its scale at insert time, so scoring a candidate is a single dot
+/// product and the result is the exact cosine against the stored codes.
+pub struct SemanticCache<S, V> {
+    capacity: usize,
+    threshold: f32,
+    tick: u64,
+    dim: usize,
+    // Entry columns; the embeddings are one contiguous row-major buffer of `dim` int8
+    // codes per entry
+    scopes: Vec<S>,
+    last_used: Vec<u64>,
+    values: Vec<V>,
+    // Per-entry code scale divided by the norm of the dequantized embedding
+    scales: Vec<f32>,
+    embeddings: Vec<i8>,
+}
+
+impl<S: Eq, V: Clone> SemanticCache<S, V> {
+    pub fn new(capacity: usize, threshold: f32) -> Self {
+        Self {
+            capacity: capacity.max(1),
+            threshold,
+            tick: 0,
+            dim: 0,
+            scopes: Vec::with_capacity(capacity),
+            last_used: Vec::with_capacity(capacity),
+            values: Vec::with_capacity(capacity),
+            scales: Vec::with_capacity(capacity),
+            embeddings: Vec::new(),
+        }
+    }
+
+    /// Return the value of the most similar entry in `scope`, if it clears the threshold.
+    pub fn get(&mut self, scope: &S, embedding: &[f32]) -> Option<V> {
+        if embedding.len() != self.dim {
+            return None;
+        }
+        let query_norm = dot(embedding, embedding).sqrt();
+        if query_norm == 0.0 {
+            return None;
+        }
+        let threshold = self.threshold * query_norm;
+
+        let (index, _) = self
+            .embeddings
+            .chunks_exact(self.dim)
+            .enumerate()
+            .filter(|&(i, _)| self.scopes[i] == *scope)
+            .map(|(i, row)| (i, dot_i8(row, embedding) * self.scales[i]))
+            .filter(|&(_, score)| score >= threshold)
+            .max_by(|a, b| a.1.total_cmp(&b.1))?;
+
+        self.tick += 1;
+        self.last_used[index] = self.tick;
+        Some(self.values[index].clone())
+    }
+
+    pub fn insert(&mut self, scope: S, embedding: Vec<f32>, value: V) {
+        // A different embedding width (e.g. after switching models) invalidates everything
+        if embedding.len() != self.dim {
+            self.clear();
+            self.dim = embedding.len();
+        }
+
+        if self.len() >= self.capacity {
+            if let Some(oldest) = (0..self.len()).min_by_key(|&i| self.last_used[i]) {
+                self.swap_remove(oldest);
+            }
+        }
+
+        self.tick += 1;
+        self.scopes.push(scope);
+        self.last_used.push(self.tick);
+        self.values.push(value);
+
+        // Symmetric quantization: the largest component maps to +/-127
+        let max = embedding.iter().fold(0.0f32, |max, v| max.max(v.abs()));
+        let scale = if max > 0.0 { max / 127.0 } else { 1.0 };
+        let start = self.embeddings.len();
+        self.embeddings.extend(embedding.iter().map(|v| (v / scale).round() as i8));
+
+        let codes = &self.embeddings[start..];
+        let norm = scale * codes.iter().map(|&c| (c as f32) * (c as f32)).sum::<f32>().sqrt();
+        self.scales.push(if norm > 0.0 { scale / norm } else { 0.0 });
+    }
+
+    fn swap_remove(&mut self, index: usize) {
+        let last = self.len() - 1;
+        self.scopes.swap_remove(index);
+        self.last_used.swap_remove(index);
+        self.values.swap_remove(index);
+        self.scales.swap_remove(index);
+        if index != last {
+            self.embeddings.copy_within(last * self.dim.., index * self.dim);
+        }
+        self.embeddings.truncate(last * self.dim);
+    }
+
+    fn clear(&mut self) {
+        self.scopes.clear();
+        self.last_used.clear();
+        self.values.clear();
+        self.scales.clear();
+        self.embeddings.clear();
+    }
+
+    pub fn len(&self) -> usize {
+        self.values.len()
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.values.is_empty()
+    }
+}
+
+fn dot(a: &[f32], b: &[f32]) -> f32 {
+    a.iter().zip(b).map(|(x, y)| x * y).sum()
+}
+
+fn dot_i8(codes: &[i8], query: &[f32]) -> f32 {
+    codes.iter().zip(query).map(|(&c, q)| c as f32 * q).sum()
+}
+
+fn f32_to_bf16(value: f32) -> u16 {
+    // Round to nearest even on the 16 dropped mantissa bits
+    let bits = value.to_bits();
+    let rounding = 0x7FFF + ((bits >> 16) & 1);
+    (bits.wrapping_add(rounding) >> 16) as u16
+}
+
+fn bf16_to_f32(value: u16) -> f32 {
+    f32::from_bits((value as u32) << 16)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn guild(id: &str) -> Option<String> {
+        Some(id.to_string())
+    }
+
+    #[test]
+    fn ttl_entries_expire() {
+        let mut cache = TtlCache::new(4, Duration::from_millis(20));
+        cache.insert("a", 1);
+        assert_eq!(cache.get(&"a"), Some(1));
+
+        std::thread::sleep(Duration::from_millis(30));
+        assert_eq!(cache.get(&"a"), None);
+        assert!(cache.is_empty());
+    }
+
+    #[test]
+    fn ttl_cache_evicts_oldest_when_full() {
+        let mut cache = TtlCache::new(2, Duration::from_secs(60));
+        cache.insert("a", 1);
+        cache.insert("b", 2);
+        cache.insert("c", 3);
+        assert_eq!(cache.len(), 2);
+        assert_eq!(cache.get(&"a"), None);
+        assert_eq!(cache.get(&"b"), Some(2));
+        assert_eq!(cache.get(&"c"), Some(3));
+
+        // Re-inserting refreshes the key, so its stale queue slot must not evict it
+        cache.insert("b", 4);
+        cache.insert("d", 5);
+        assert_eq!(cache.len(), 2);
+        assert_eq!(cache.get(&"b"), Some(4));
+        assert_eq!(cache.get(&"c"), None);
+        assert_eq!(cache.get(&"d"), Some(5));
+    }
+
+    #[test]
+    fn bump_changes_version() {
+        let mut versions = GuildVersions::new(4);
+        let a = guild("a");
+        assert_eq!(versions.get(&a), 0);
+
+        versions.bump(&a);
+        let first = versions.get(&a);
+        assert!(first > 0);
+
+        versions.bump(&guild("b"));
+        assert_eq!(versions.get(&a), first);
+
+        versions.bump(&a);
+        assert!(versions.get(&a) > first);
+    }
+
+    #[test]
+    fn evicted_guild_never_reads_an_earlier_version() {
+        let mut versions = GuildVersions::new(1);
+        let (a, b) = (guild("a"), guild("b"));
+        let mut seen = Vec::new();
+
+        for _ in 0..3 {
+            versions.bump(&a);
+            let bumped = versions.get(&a);
+            assert!(seen.iter().all(|&v| bumped > v));
+            seen.push(bumped);
+
+            // Bumping another guild evicts this one; it may read higher but never lower
+            versions.bump(&b);
+            assert_eq!(versions.len(), 1);
+            let evicted = versions.get(&a);
+            assert!(evicted >= bumped);
+            seen.push(evicted);
+        }
+
+        // A guild that was never bumped reads as the eviction floor
+        assert_eq!(versions.get(&guild("c")), versions.get(&a));
+    }
+
+    #[test]
+    fn settled_waits_for_quiet_period() {
+        let mut versions = GuildVersions::new(4);
+        let a = guild("a");
+        assert!(versions.settled(&a, Duration::from_secs(30)));
+
+        versions.bump(&a);
+        assert!(!versions.settled(&a, Duration::from_secs(30)));
+        assert!(versions.settled(&a, Duration::ZERO));
+        assert!(versions.settled(&None, Duration::from_secs(30)));
+
+        std::thread::sleep(Duration::from_millis(20));
+        assert!(versions.settled(&a, Duration::from_millis(10)));
+    }
+
+    #[test]
+    fn semantic_cache_hits_above_threshold() {
+        let mut cache = SemanticCache::new(4, 0.95);
+        cache.insert("g", vec![0.3, -0.7, 0.2], "answer");
+
+        // Cosine is scale invariant, and int8 codes keep the stored vector close enough
+        assert_eq!(cache.get(&"g", &[0.3, -0.7, 0.2]), Some("answer"));
+        assert_eq!(cache.get(&"g", &[3.0, -7.0, 2.0]), Some("answer"));
+        assert_eq!(cache.get(&"g", &[0.32, -0.68, 0.2]), Some("answer"));
+    }
+
+    #[test]
+    fn semantic_cache_misses() {
+        let mut cache = SemanticCache::new(4, 0.95);
+        cache.insert("g", vec![1.0, 0.0, 0.0], "answer");
+
+        // Below the threshold (cosine ~0.89), another scope, a zero query, another width
+        assert_eq!(cache.get(&"g", &[1.0, 0.5, 0.0]), None);
+        assert_eq!(cache.get(&"h", &[1.0, 0.0, 0.0]), None);
+        assert_eq!(cache.get(&"g", &[0.0, 0.0, 0.0]), None);
+        assert_eq!(cache.get(&"g", &[1.0, 0.0]), None);
+    }
+
+    #[test]
+    fn semantic_cache_evicts_least_recently_used() {
+        let mut cache = SemanticCache::new(2, 0.95);
+        cache.insert("g", vec![1.0, 0.0, 0.0], "x");
+        cache.insert("g", vec![0.0, 1.0, 0.0], "y");
+        assert_eq!(cache.get(&"g", &[1.0, 0.0, 0.0]), Some("x"));
+
+        cache.insert("g", vec![0.0, 0.0, 1.0], "z");
+        assert_eq!(cache.len(), 2);
+        assert_eq!(cache.get(&"g", &[0.0, 1.0, 0.0]), None);
+        assert_eq!(cache.get(&"g", &[1.0, 0.0, 0.0]), Some("x"));
+        assert_eq!(cache.get(&"g", &[0.0, 0.0, 1.0]), Some("z"));
+
+        // A new embedding width drops every entry
+        cache.insert("g", vec![1.0, 0.0], "w");
+        assert_eq!(cache.len(), 1);
+    }
+}
@@ -1,46 +1,71 @@
-use std::collections::HashMap;
-use std::time::{Duration, SystemTime, UNIX_EPOCH};
-use tracing::{info, warn, error};
+use std::collections::{HashMap, VecDeque};
+use futures::{future, stream, StreamExt};
+use std::time::{Duration, Instant, SystemTime, UNIX_EPOCH};
+use tracing::{debug, info, warn, error};
 use uuid::Uuid;
 use crate::schema::{MessageEvent, MessageChunk};
 use crate::config::Config;
-use crate::cohere::{get_embedding, generate_summary};
-use crate::pinecone::upsert_chunk_to_pinecone;
+use crate::cohere::{get_embeddings, generate_summary};
+use crate::pinecone::upsert_chunks_to_pinecone;
 
-const MAX_CHUNK_SIZE: usize = 12;
-const MIN_CHUNK_SIZE: usize = 3;
+pub const MIN_CHUNK_SIZE: usize = 3;
 const TIME_GAP_MINUTES: u64 = 15;
 const SUMMARY_THRESHOLD_CHARS: usize = 2000;
-
+const MAX_CONCURRENT_SUMMARIES: usize = 4;
+// Buffers idle this long are dropped even if they hold too few messages to chunk
+const BUFFER_IDLE_TTL: Duration = Duration::from_secs(60 * 60);
+const SWEEP_INTERVAL: Duration = Duration::from_secs(60);
+// Message ids remembered per channel for dropping redelivered duplicates
+const RECENT_IDS: usize = 256;
+
+// Column layout: guild/channel are stored once per buffer and each message only
+// contributes its own fields, so create_chunk can hand the columns off without cloning
 #[derive(Debug)]
 pub struct MessageBuffer {
-    messages: Vec<MessageEvent>,
+    guild_id: Option<String>,
+    channel_id: String,
+    ids: Vec<String>,
+    author_ids: Vec<String>,
+    timestamps: Vec<String>,
+    texts: Vec<String>,
     last_message_time: SystemTime,
+    last_activity: Instant,
+    // Most recently buffered message ids, oldest first; survives flushes so redelivered
+    // messages (e.g. Kafka replay after a restart or rebalance) are not chunked twice.
+    // Only exact ids count: messages can arrive out of order, so a lower id is not a replay.
+    recent_ids: VecDeque<u64>,
 }
 
 impl MessageBuffer {
-    fn new() -> Self {
+    fn new(guild_id: Option<String>, channel_id: String) -> Self {
         Self {
-            messages: Vec::new(),
+            guild_id,
+            channel_id,
+            ids: Vec::new(),
+            author_ids: Vec::new(),
+            timestamps: Vec::new(),
+            texts: Vec::new(),
             last_message_time: UNIX_EPOCH,
+            last_activity: Instant::now(),
+            recent_ids: VecDeque::with_capacity(RECENT_IDS),
         }
     }
 
     fn is_empty(&self) -> bool {
-        self.messages.is_empty()
+        self.ids.is_empty()
     }
 
     fn len(&self) -> usize {
-        self.messages.len()
+        self.ids.len()
     }
 
-    fn should_flush(&self, new_message_time: SystemTime) -> bool {
-        if self.messages.is_empty() {
+    fn should_flush(&self, new_message_time: SystemTime, max_chunk_size: usize) -> bool {
+        if self.is_empty() {
             return false;
         }
 
         // Check if buffer is at max capacity
-        if self.len() >= MAX_CHUNK_SIZE {
+        if self.len() >= max_chunk_size {
             return true;
         }
 
@@ -52,69 +77,129 @@ impl MessageBuffer {
         }
     }
 
-    fn add_message(&mut self, message: MessageEvent) {
-        if let Ok(timestamp) = chrono::DateTime::parse_from_rfc3339(&message.timestamp) {
-            self.last_message_time = timestamp.into();
+    fn is_duplicate(&self, message_id: u64) -> bool {
+        message_id != 0 && self.recent_ids.contains(&message_id)
+    }
+
+    fn add_message(&mut self, message: MessageEvent, message_time: SystemTime, message_id: u64) {
+        self.last_message_time = message_time;
+        self.last_activity = Instant::now();
+        if message_id != 0 {
+            if self.recent_ids.len() >= RECENT_IDS {
+                self.recent_ids.pop_front();
+            }
+            self.recent_ids.push_back(message_id);
         }
-        self.messages.push(message);
+
+        let MessageEvent { id, author_id, timestamp, text, .. } = message;
+        self.ids.push(id);
+        self.author_ids.push(author_id);
+        self.timestamps.push(timestamp);
+        self.texts.push(text);
     }
 
     fn create_chunk(&mut self) -> Option<MessageChunk> {
-        if self.messages.len() < MIN_CHUNK_SIZE {
+        let message_count = self.len();
+        if message_count < MIN_CHUNK_SIZE {
             return None;
         }
 
         let chunk_id = Uuid::new_v4().to_string();
-        let first_msg = &self.messages[0];
-        let last_msg = &self.messages[self.messages.len() - 1];
+
+        // Combine all message texts into one preallocated buffer
+        let mut full_text = String::with_capacity(
+            self.author_ids.iter().zip(&self.texts).map(|(author, text)| author.len() + text.len() + 3).sum()
+        );
+        for (i, (author, text)) in self.author_ids.iter().zip(&self.texts).enumerate() {
+            if i > 0 {
+                full_text.push('\n');
+            }
+            full_text.push_str(author);
+            full_text.push_str(": ");
+            full_text.push_str(text);
+        }
+
+        // Draining keeps each column's capacity for the next chunk
+        let mut ids = self.ids.drain(..);
+        let first_msg_id = ids.next().unwrap_or_default();
+        let last_msg_id = ids.last().unwrap_or_else(|| first_msg_id.clone());
+
+        let mut timestamps = self.timestamps.drain(..);
+        let first_timestamp = timestamps.next().unwrap_or_default();
+        let last_timestamp = timestamps.last().unwrap_or_else(|| first_timestamp.clone());
 
         // Collect unique authors
-        let mut authors: Vec<String> = self.messages
-            .iter()
-            .map(|msg| msg.author_id.clone())
+        let mut authors: Vec<String> = self.author_ids
+            .drain(..)
             .collect::<std::collections::HashSet<_>>()
             .into_iter()
             .collect();
         authors.sort();
 
-        // Combine all message texts
-        let full_text = self.messages
-            .iter()
-            .map(|msg| format!("{}: {}", msg.author_id, msg.text))
-            .collect::<Vec<_>>()
-            .join("\n");
+        self.texts.clear();
 
-        let chunk = MessageChunk {
+        Some(MessageChunk {
             chunk_id,
-            guild_id: first_msg.guild_id.clone(),
-            channel_id: first_msg.channel_id.clone(),
-            first_msg_id: first_msg.id.clone(),
-            last_msg_id: last_msg.id.clone(),
-            first_timestamp: first_msg.timestamp.clone(),
-            last_timestamp: last_msg.timestamp.clone(),
-            message_count: self.messages.len(),
+            guild_id: self.guild_id.clone(),
+            channel_id: self.channel_id.clone(),
+            first_msg_id,
+            last_msg_id,
+            first_timestamp,
+            last_timestamp,
+            message_count,
             authors,
             full_text,
             summary: None,
             has_summary: false,
-        };
-
-        // Clear the buffer
-        self.messages.clear();
-
-        Some(chunk)
+        })
     }
 }
 
 pub struct ChunkManager {
     buffers: HashMap<String, MessageBuffer>,
+    last_sweep: Instant,
 }
 
 impl ChunkManager {
     pub fn new() -> Self {
         Self {
             buffers: HashMap::new(),
+            last_sweep: Instant::now(),
+        }
+    }
+
+    /// Flush buffers for channels that have gone quiet and drop long-idle ones, so the
+    /// buffer map only holds recently active channels. Runs at most once per SWEEP_INTERVAL.
+    ///
+    /// A buffer idle for BUFFER_IDLE_TTL that still holds fewer than MIN_CHUNK_SIZE messages
+    /// is dropped along with them; those messages are never indexed.
+    fn evict_idle_buffers(&mut self) -> Vec<MessageChunk> {
+        let now = Instant::now();
+        if now.duration_since(self.last_sweep) < SWEEP_INTERVAL {
+            return Vec::new();
         }
+        self.last_sweep = now;
+
+        let time_gap = Duration::from_secs(TIME_GAP_MINUTES * 60);
+        let mut chunks = Vec::new();
+        self.buffers.retain(|buffer_key, buffer| {
+            let idle = now.duration_since(buffer.last_activity);
+            if idle < time_gap {
+                return true;
+            }
+            if let Some(chunk) = buffer.create_chunk() {
+                info!(buffer_key=?buffer_key, chunk_id=?chunk.chunk_id, "Flushed idle buffer to chunk");
+                chunks.push(chunk);
+            }
+            if idle < BUFFER_IDLE_TTL {
+                return !buffer.is_empty();
+            }
+            if !buffer.is_empty() {
+                info!(buffer_key=?buffer_key, dropped = buffer.len(), "Dropped messages from idle buffer too short to chunk");
+            }
+            false
+        });
+        chunks
     }
 
     fn get_buffer_key(guild_id: &Option<String>, channel_id: &str) -> String {
@@ -125,6 +210,17 @@ impl ChunkManager {
     }
 
     pub async fn process_message(&mut self, cfg: &Config, message: MessageEvent) -> Result<(), Box<dyn std::error::Error + Send + Sync>> {
+        let chunks = self.buffer_message(cfg, message)?;
+        process_chunks(cfg, chunks).await
+    }
+
+    /// Add a message to its channel buffer and return the chunks that are ready, without
+    /// doing any network I/O, so callers sharing the manager behind a lock can release it
+    /// before handing the chunks to `process_chunks`.
+    pub fn buffer_message(&mut self, cfg: &Config, message: MessageEvent) -> Result<Vec<MessageChunk>, Box<dyn std::error::Error + Send + Sync>> {
+        // Every chunk this message produces is embedded and upserted together
+        let mut chunks = self.evict_idle_buffers();
+
         let buffer_key = Self::get_buffer_key(&message.guild_id, &message.channel_id);
 
         // Parse message timestamp
@@ -132,95 +228,173 @@ impl ChunkManager {
             .map_err(|e| format!("Invalid timestamp: {}", e))?
             .into();
 
-        let mut chunk_to_process = None;
+        let buffer = self.buffers
+            .entry(buffer_key)
+            .or_insert_with(|| MessageBuffer::new(message.guild_id.clone(), message.channel_id.clone()));
 
-        // Check if we should flush the current buffer before adding the new message
-        {
-            let buffer = self.buffers.entry(buffer_key.clone()).or_insert_with(MessageBuffer::new);
-            if buffer.should_flush(message_time) {
-                chunk_to_process = buffer.create_chunk();
-            }
+        // Discord ids are numeric snowflakes
+        let message_id = message.id.parse::<u64>().unwrap_or(0);
+        if buffer.is_duplicate(message_id) {
+            debug!(message_id = %message.id, "Skipping duplicate message");
+            return Ok(chunks);
         }
 
-        // Process the chunk if created (outside of the borrow)
-        if let Some(chunk) = chunk_to_process {
-            info!(chunk_id=?chunk.chunk_id, message_count=chunk.message_count, "Created chunk");
-            self.process_chunk(cfg, chunk).await?;
+        // Check if we should flush the current buffer before adding the new message
+        if buffer.should_flush(message_time, cfg.chunk_max_messages) {
+            if let Some(chunk) = buffer.create_chunk() {
+                info!(chunk_id=?chunk.chunk_id, message_count=chunk.message_count, "Created chunk");
+                chunks.push(chunk);
+            }
         }
 
         // Add the new message to the buffer
-        let buffer = self.buffers.get_mut(&buffer_key).unwrap();
-        buffer.add_message(message);
+        buffer.add_message(message, message_time, message_id);
 
         // Check if buffer is now at max capacity and should be flushed
-        let mut chunk_to_process = None;
-        if buffer.len() >= MAX_CHUNK_SIZE {
-            chunk_to_process = buffer.create_chunk();
+        if buffer.len() >= cfg.chunk_max_messages {
+            if let Some(chunk) = buffer.create_chunk() {
+                info!(chunk_id=?chunk.chunk_id, message_count=chunk.message_count, "Created chunk (max size)");
+                chunks.push(chunk);
+            }
         }
 
-        // Process the chunk if created
-        if let Some(chunk) = chunk_to_process {
-            info!(chunk_id=?chunk.chunk_id, message_count=chunk.message_count, "Created chunk (max size)");
-            self.process_chunk(cfg, chunk).await?;
-        }
+        Ok(chunks)
+    }
 
-        Ok(())
+    pub async fn flush_all_buffers(&mut self, cfg: &Config) -> Result<(), Box<dyn std::error::Error + Send + Sync>> {
+        // Process all collected chunks together
+        let chunks = self.drain_buffers();
+        process_chunks(cfg, chunks).await
     }
 
-    async fn process_chunk(&self, cfg: &Config, mut chunk: MessageChunk) -> Result<(), Box<dyn std::error::Error + Send + Sync>> {
-        // Generate summary if chunk is long enough
-        if chunk.full_text.len() > SUMMARY_THRESHOLD_CHARS {
-            match generate_summary(cfg, &chunk.full_text).await {
-                Ok(summary) => {
-                    chunk.summary = Some(summary);
-                    chunk.has_summary = true;
-                    info!(chunk_id=?chunk.chunk_id, "Generated summary for chunk");
-                }
-                Err(err) => {
-                    warn!(chunk_id=?chunk.chunk_id, error=?err, "Failed to generate summary");
-                }
+    // Turn every buffer holding enough messages into a chunk
+    fn drain_buffers(&mut self) -> Vec<MessageChunk> {
+        let mut chunks = Vec::new();
+        for (buffer_key, buffer) in self.buffers.iter_mut() {
+            if let Some(chunk) = buffer.create_chunk() {
+                info!(buffer_key=?buffer_key, chunk_id=?chunk.chunk_id, "Flushed buffer to chunk");
+                chunks.push(chunk);
             }
         }
+        chunks
+    }
+}
 
-        // Get embedding for the chunk (use summary if available, otherwise full text)
-        let text_to_embed = if chunk.has_summary {
-            chunk.summary.as_ref().unwrap()
-        } else {
-            &chunk.full_text
-        };
-
-        match get_embedding(cfg, text_to_embed).await {
-            Ok(embedding) => {
-                if let Err(err) = upsert_chunk_to_pinecone(cfg, &chunk, embedding).await {
-                    error!(chunk_id=?chunk.chunk_id, error=?err, "Failed to upsert chunk to Pinecone");
-                }
+/// Summarize long chunks, embed all chunks in one batch and upsert them to Pinecone.
+pub async fn process_chunks(cfg: &Config, mut chunks: Vec<MessageChunk>) -> Result<(), Box<dyn std::error::Error + Send + Sync>> {
+    if chunks.is_empty() {
+        return Ok(());
+    }
+
+    // Generate summaries for chunks that are long enough, a few requests at a time
+    let summaries: Vec<_> = stream::iter(chunks.iter().enumerate())
+        .filter(|(_, chunk)| future::ready(chunk.full_text.len() > SUMMARY_THRESHOLD_CHARS))
+        .map(|(i, chunk)| async move { (i, generate_summary(cfg, &chunk.full_text).await) })
+        .buffer_unordered(MAX_CONCURRENT_SUMMARIES)
+        .collect()
+        .await;
+
+    for (i, result) in summaries {
+        let chunk = &mut chunks[i];
+        match result {
+            Ok(summary) => {
+                chunk.summary = Some(summary);
+                chunk.has_summary = true;
+                info!(chunk_id=?chunk.chunk_id, "Generated summary for chunk");
             }
             Err(err) => {
-                error!(chunk_id=?chunk.chunk_id, error=?err, "Failed to get embedding for chunk");
+                warn!(chunk_id=?chunk.chunk_id, error=?err, "Failed to generate summary");
             }
         }
-
-        Ok(())
     }
 
-    pub async fn flush_all_buffers(&mut self, cfg: &Config) -> Result<(), Box<dyn std::error::Error + Send + Sync>> {
-        let mut chunks_to_process = Vec::new();
+    // Embed all chunks in one request (use summary if available, otherwise full text)
+    let texts_to_embed: Vec<&str> = chunks
+        .iter()
+        .map(|chunk| chunk.summary.as_deref().unwrap_or(&chunk.full_text))
+        .collect();
 
-        // Collect all chunks from all buffers
-        for (buffer_key, buffer) in self.buffers.iter_mut() {
-            if !buffer.is_empty() {
-                if let Some(chunk) = buffer.create_chunk() {
-                    info!(buffer_key=?buffer_key, chunk_id=?chunk.chunk_id, "Flushed buffer to chunk");
-                    chunks_to_process.push(chunk);
-                }
+    match get_embeddings(cfg, &texts_to_embed).await {
+        Ok(embeddings) => {
+            if let Err(err) = upsert_chunks_to_pinecone(cfg, &chunks, embeddings).await {
+                error!(count = chunks.len(), error=?err, "Failed to upsert chunks to Pinecone");
+            }
+        }
+        Err(err) => {
+            for chunk in &chunks {
+                error!(chunk_id=?chunk.chunk_id, error=?err, "Failed to get embedding for chunk");
             }
         }
+    }
+
+    Ok(())
+}
 
-        // Process all collected chunks
-        for chunk in chunks_to_process {
-            self.process_chunk(cfg, chunk).await?;
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use crate::cohere::MAX_EMBED_BATCH;
+    use crate::config::EmbedBackend;
+
+    fn test_config(chunk_max_messages: usize) -> Config {
+        Config {
+            discord_token: String::new(),
+            cohere_key: String::new(),
+            pinecone_key: String::new(),
+            pinecone_host: String::new(),
+            pinecone_query_url: String::new(),
+            pinecone_upsert_url: String::new(),
+            pinecone_index: String::new(),
+            namespace: String::new(),
+            kafka_brokers: String::new(),
+            kafka_group_id: String::new(),
+            elasticsearch_url: String::new(),
+            elasticsearch_index: String::new(),
+            embed_batch_size: MAX_EMBED_BATCH,
+            embed_backend: EmbedBackend::Cohere,
+            tei_embed_url: String::new(),
+            chunk_max_messages,
         }
+    }
 
-        Ok(())
+    fn message(id: &str, second: u32) -> MessageEvent {
+        MessageEvent {
+            id: id.to_string(),
+            guild_id: Some("1".to_string()),
+            channel_id: "2".to_string(),
+            author_id: "3".to_string(),
+            timestamp: format!("2024-01-01T00:00:{:02}Z", second),
+            text: format!("message {}", id),
+        }
     }
-}
\ No newline at end of file
+
+    #[test]
+    fn out_of_order_messages_are_chunked() {
+        let cfg = test_config(3);
+        let mut manager = ChunkManager::new();
+
+        assert!(manager.buffer_message(&cfg, message("1003", 3)).unwrap().is_empty());
+        assert!(manager.buffer_message(&cfg, message("1001", 1)).unwrap().is_empty());
+        let chunks = manager.buffer_message(&cfg, message("1002", 2)).unwrap();
+
+        assert_eq!(chunks.len(), 1);
+        assert_eq!(chunks[0].message_count, 3);
+        assert!(chunks[0].full_text.contains("message 1001"));
+        assert!(chunks[0].full_text.contains("message 1002"));
+    }
+
+    #[test]
+    fn redelivered_messages_are_skipped() {
+        let cfg = test_config(3);
+        let mut manager = ChunkManager::new();
+
+        manager.buffer_message(&cfg, message("1001", 1)).unwrap();
+        manager.buffer_message(&cfg, message("1002", 2)).unwrap();
+        assert!(manager.buffer_message(&cfg, message("1001", 1)).unwrap().is_empty());
+        let chunks = manager.buffer_message(&cfg, message("1003", 3)).unwrap();
+
+        assert_eq!(chunks.len(), 1);
+        assert_eq!(chunks[0].message_count, 3);
+        assert_eq!(chunks[0].full_text.matches("message 1001").count(), 1);
+    }
+}
@@ -1,149 +1,322 @@
-use reqwest::Client;
+use std::collections::HashMap;
+use std::sync::Mutex;
+use std::sync::atomic::{AtomicUsize, Ordering};
+use serde::{Deserialize, Serialize};
 use serde_json::json;
 use tracing::{info, warn};
-use crate::{config::Config, schema::{QueryResult, ChunkQueryResult}, metrics::EMBEDDING_GENERATION_DURATION};
+use crate::{
+    config::{Config, EmbedBackend},
+    schema::{QueryResult, ChunkQueryResult},
+    metrics::{EMBEDDING_GENERATION_DURATION, EMBEDDING_CACHE_HITS, EMBEDDING_CACHE_MISSES},
+    http_client::HTTP_CLIENT,
+    cache::EmbeddingCache,
+};
 
 type DynErr = Box<dyn std::error::Error + Send + Sync>;
 
+// Cohere accepts at most 96 texts per embed call
+pub const MAX_EMBED_BATCH: usize = 96;
+
+const EMBEDDING_CACHE_CAPACITY: usize = 5000;
+
+// Long pastes (code blocks, logs) are cut to this many characters before embedding
+pub const MAX_EMBED_CHARS: usize = 2048;
+
+lazy_static::lazy_static! {
+    // Repeated texts ("ok", emotes, repeated questions, re-flushed chunks) skip the embedding round trip
+    static ref EMBEDDING_CACHE: Mutex<EmbeddingCache> = Mutex::new(EmbeddingCache::new(EMBEDDING_CACHE_CAPACITY));
+}
+
 pub async fn get_embedding(cfg: &Config, text: &str) -> Result<Vec<f32>, DynErr> {
-    let _timer = EMBEDDING_GENERATION_DURATION.start_timer();
-    let client = Client::new();
+    get_embeddings(cfg, &[text])
+        .await?
+        .pop()
+        .ok_or_else(|| "No embeddings found".into())
+}
 
-    let res = client
-        .post("https://api.cohere.ai/v1/embed")
-        .bearer_auth(&cfg.cohere_key)
-        .json(&json!({
-            "model": "embed-english-v3.0",
-            "input_type": "search_document",
-            "texts": [text]
-        }))
-        .send()
-        .await?;
+/// Send one throwaway embed request so the first real query doesn't pay for opening the
+/// connection (and, with TEI, loading the model) on the request path.
+pub async fn warm_up(cfg: &Config) {
+    let started = std::time::Instant::now();
+    match embed_batch(cfg, &["warm up"]).await {
+        Ok(Some(_)) => info!(backend = ?cfg.embed_backend, elapsed_ms = started.elapsed().as_millis() as u64, "Embedding backend warmed up"),
+        Ok(None) => warn!(backend = ?cfg.embed_backend, "Embedding warm-up returned no embeddings"),
+        Err(err) => warn!(backend = ?cfg.embed_backend, "Embedding warm-up failed: {}", err),
+    }
+}
 
-    if !res.status().is_success() {
-        return Err(format!("Cohere error: {}", res.text().await?).into());
+pub async fn get_embeddings(cfg: &Config, texts: &[&str]) -> Result<Vec<Vec<f32>>, DynErr> {
+    // Serve what we can from the cache and only send the misses to the embedding service
+    let mut embeddings: Vec<Option<Vec<f32>>> = Vec::with_capacity(texts.len());
+    // (position in `texts`, index into `unique_misses`)
+    let mut misses = Vec::new();
+    // Identical texts within the batch ("ok", "lol", repeated bot output) are embedded once;
+    // keyed on the trimmed text, like the cache
+    let mut unique_misses: Vec<&str> = Vec::new();
+    let mut unique_index: HashMap<&str, usize> = HashMap::new();
+    {
+        let mut cache = EMBEDDING_CACHE.lock().unwrap();
+        for (i, text) in texts.iter().enumerate() {
+            let cached = cache.get(text);
+            if cached.is_none() {
+                let unique = *unique_index.entry(text.trim()).or_insert_with(|| {
+                    unique_misses.push(text);
+                    unique_misses.len() - 1
+                });
+                misses.push((i, unique));
+            }
+            embeddings.push(cached);
+        }
     }
+    EMBEDDING_CACHE_HITS.inc_by((texts.len() - misses.len()) as f64);
+    EMBEDDING_CACHE_MISSES.inc_by(misses.len() as f64);
 
-    let body: serde_json::Value = res.json().await?;
-    if let Some(array) = body["embeddings"][0].as_array() {
-        let emb: Vec<f32> = array.iter().filter_map(|v| v.as_f64()).map(|v| v as f32).collect();
-        info!(len = emb.len(), sample = ?&emb[..5.min(emb.len())], "Got embedding");
-        Ok(emb)
-    } else {
-        warn!("No embeddings in Cohere response: {body:?}");
-        Err("No embeddings found".into())
+    if !unique_misses.is_empty() {
+        let fresh = embed_uncached(cfg, &unique_misses).await?;
+
+        let mut cache = EMBEDDING_CACHE.lock().unwrap();
+        for (text, embedding) in unique_misses.iter().zip(&fresh) {
+            cache.insert(text, embedding.clone());
+        }
+        for (i, unique) in misses {
+            embeddings[i] = Some(fresh[unique].clone());
+        }
     }
+
+    embeddings
+        .into_iter()
+        .collect::<Option<Vec<_>>>()
+        .ok_or_else(|| "No embeddings found".into())
 }
 
-pub async fn generate_response(cfg: &Config, query: &str, context_messages: &[QueryResult]) -> Result<String, DynErr> {
-    let client = Client::new();
+async fn embed_uncached(cfg: &Config, texts: &[&str]) -> Result<Vec<Vec<f32>>, DynErr> {
+    let mut embeddings = Vec::with_capacity(texts.len());
 
-    let context = context_messages
-        .iter()
-        .map(|msg| format!("- {}", msg.text))
-        .collect::<Vec<_>>()
-        .join("\n");
+    // Work stack of batches, first batch on top so output order matches input order
+    let mut pending: Vec<&[&str]> = texts.chunks(embed_batch_limit(cfg)).rev().collect();
+    while let Some(batch) = pending.pop() {
+        match embed_batch(cfg, batch).await {
+            Ok(Some(batch_embeddings)) => {
+                grow_embed_batch_limit(cfg, batch.len());
+                embeddings.extend(batch_embeddings);
+            }
+            Ok(None) if batch.len() > 1 => {
+                // Fall back to one request per text if the batched response is unusable
+                warn!(count = batch.len(), "Batched embedding failed, retrying sequentially");
+                for text in batch {
+                    match embed_batch(cfg, std::slice::from_ref(text)).await? {
+                        Some(mut single) if single.len() == 1 => embeddings.push(single.remove(0)),
+                        _ => return Err("No embeddings found".into()),
+                    }
+                }
+            }
+            Ok(None) => return Err("No embeddings found".into()),
+            Err(err) if batch.len() > 1 && is_retryable(&err) => {
+                // Overloaded or oversized request: halve the batch and retry both halves
+                let (left, right) = batch.split_at(batch.len() / 2);
+                warn!(count = batch.len(), error = %err, "Embedding batch failed, retrying in halves");
+                EMBED_BATCH_LIMIT.fetch_min(left.len(), Ordering::Relaxed);
+                pending.push(right);
+                pending.push(left);
+            }
+            Err(err) => return Err(err),
+        }
+    }
+    Ok(embeddings)
+}
 
-    let res = client
-        .post("https://api.cohere.ai/v1/chat")
-        .bearer_auth(&cfg.cohere_key)
-        .json(&json!({
-            "model": "command-r-08-2024",
-            "message": query,
-            "preamble": format!(
-                "You are a helpful assistant that answers questions based on Discord message history. \
-                Here are some relevant messages from the conversation:\n\n{}\n\n\
-                Please provide a helpful answer based on the context above. If the context doesn't contain \
-                enough information to answer the question, say so.",
-                context
-            ),
-            "max_tokens": 300,
-            "temperature": 0.7
-        }))
-        .send()
-        .await?;
+// Adaptive upper bound on batch size: halved on overload, grown back by one per full successful batch
+static EMBED_BATCH_LIMIT: AtomicUsize = AtomicUsize::new(MAX_EMBED_BATCH);
 
-    if !res.status().is_success() {
-        return Err(format!("Cohere generate error: {}", res.text().await?).into());
+fn embed_batch_limit(cfg: &Config) -> usize {
+    EMBED_BATCH_LIMIT.load(Ordering::Relaxed).min(cfg.embed_batch_size).max(1)
+}
+
+fn grow_embed_batch_limit(cfg: &Config, batch_len: usize) {
+    let limit = embed_batch_limit(cfg);
+    if batch_len >= limit && limit < cfg.embed_batch_size {
+        let _ = EMBED_BATCH_LIMIT.compare_exchange(limit, limit + 1, Ordering::Relaxed, Ordering::Relaxed);
     }
+}
 
-    let body: serde_json::Value = res.json().await?;
-    if let Some(text) = body["text"].as_str() {
-        let response = text.trim().to_string();
-        info!(len = response.len(), "Generated response");
-        Ok(response)
-    } else {
-        warn!("No text in Cohere response: {body:?}");
-        Err("No generated text found".into())
+#[derive(Debug)]
+struct RetryableError(String);
+
+impl std::fmt::Display for RetryableError {
+    fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
+        f.write_str(&self.0)
     }
 }
 
-pub async fn generate_summary(cfg: &Config, text: &str) -> Result<String, DynErr> {
-    let client = Client::new();
+impl std::error::Error for RetryableError {}
 
-    let res = client
-        .post("https://api.cohere.ai/v1/chat")
-        .bearer_auth(&cfg.cohere_key)
-        .json(&json!({
-            "model": "command-r-08-2024",
-            "message": "Please provide a concise summary of this Discord conversation in 2-3 sentences.",
-            "preamble": format!(
-                "You are a helpful assistant that summarizes Discord conversations. \
-                Here is the conversation to summarize:\n\n{}\n\n\
-                Focus on the main topics discussed and key information shared.",
-                text
-            ),
-            "max_tokens": 150,
-            "temperature": 0.3
-        }))
-        .send()
-        .await?;
+fn is_retryable(err: &DynErr) -> bool {
+    if err.downcast_ref::<RetryableError>().is_some() {
+        return true;
+    }
+    err.downcast_ref::<reqwest::Error>()
+        .map_or(false, |e| e.is_timeout() || e.is_connect())
+}
 
-    if !res.status().is_success() {
-        return Err(format!("Cohere summarize error: {}", res.text().await?).into());
+async fn embed_batch(cfg: &Config, texts: &[&str]) -> Result<Option<Vec<Vec<f32>>>, DynErr> {
+    let _timer = EMBEDDING_GENERATION_DURATION.start_timer();
+    let client = &*HTTP_CLIENT;
+    let inputs: Vec<String> = texts.iter().map(|text| prepare_embed_input(text)).collect();
+
+    let request = match cfg.embed_backend {
+        EmbedBackend::Cohere => client
+            .post("https://api.cohere.ai/v1/embed")
+            .bearer_auth(&cfg.cohere_key)
+            .json(&CohereEmbedRequest {
+                model: "embed-english-v3.0",
+                input_type: "search_document",
+                texts: &inputs,
+            }),
+        EmbedBackend::Tei => client
+            .post(&cfg.tei_embed_url)
+            .json(&TeiEmbedRequest {
+                inputs: &inputs,
+                normalize: true,
+                truncate: true,
+            }),
+    };
+    let res = request.send().await?;
+
+    let status = res.status();
+    if status.is_server_error() || status == reqwest::StatusCode::PAYLOAD_TOO_LARGE {
+        return Err(Box::new(RetryableError(format!("Embedding error: {}", res.text().await?))));
+    }
+    if !status.is_success() {
+        return Err(format!("Embedding error: {}", res.text().await?).into());
     }
 
-    let body: serde_json::Value = res.json().await?;
-    if let Some(summary) = body["text"].as_str() {
-        let cleaned_summary = summary.trim().to_string();
-        info!(len = cleaned_summary.len(), "Generated summary");
-        Ok(cleaned_summary)
+    let body = res.bytes().await?;
+    let parsed = match cfg.embed_backend {
+        EmbedBackend::Cohere => serde_json::from_slice::<EmbedResponse>(&body).map(|parsed| parsed.embeddings),
+        // TEI answers with the bare list of vectors
+        EmbedBackend::Tei => serde_json::from_slice::<Vec<Vec<f32>>>(&body).map(Some),
+    };
+    let embeddings = match parsed {
+        Ok(embeddings) => embeddings,
+        Err(err) => {
+            warn!(error = %err, backend = ?cfg.embed_backend, "Unparseable embed response");
+            return Ok(None);
+        }
+    };
+
+    match embeddings {
+        Some(mut embeddings) if embeddings.len() == texts.len() => {
+            // Unit-length vectors make dot product equal cosine similarity, both in Pinecone
+            // and for in-process comparisons
+            embeddings.iter_mut().for_each(|embedding| l2_normalize(embedding));
+            info!(count = embeddings.len(), dim = embeddings[0].len(), "Got embeddings");
+            Ok(Some(embeddings))
+        }
+        _ => {
+            warn!(backend = ?cfg.embed_backend, "No embeddings in response: {}", String::from_utf8_lossy(&body));
+            Ok(None)
+        }
+    }
+}
+
+#[derive(Serialize)]
+struct CohereEmbedRequest<'a> {
+    model: &'static str,
+    input_type: &'static str,
+    texts: &'a [String],
+}
+
+#[derive(Serialize)]
+struct TeiEmbedRequest<'a> {
+    inputs: &'a [String],
+    normalize: bool,
+    truncate: bool,
+}
+
+#[derive(Deserialize)]
+struct EmbedResponse {
+    embeddings: Option<Vec<Vec<f32>>>,
+}
+
+/// Scale a vector to unit length in place; zero vectors are left unchanged.
+pub fn l2_normalize(vector: &mut [f32]) {
+    let norm = vector.iter().map(|v| v * v).sum::<f32>().sqrt();
+    if norm > 0.0 {
+        vector.iter_mut().for_each(|v| *v /= norm);
+    }
+}
+
+/// Strip mentions and custom emoji (`<@123>`, `<@!123>`, `<@&123>`, `<#123>`, `<:name:123>`,
+/// `<a:name:123>`), which carry no meaning for the embedding, and cap the text at
+/// MAX_EMBED_CHARS characters.
+fn prepare_embed_input(text: &str) -> String {
+    let mut cleaned = String::with_capacity(text.len().min(MAX_EMBED_CHARS * 4));
+    let mut chars = 0;
+    let mut rest = text;
+    while let Some(c) = rest.chars().next() {
+        if chars >= MAX_EMBED_CHARS {
+            break;
+        }
+        if c == '<' {
+            if let Some(len) = discord_markup_len(rest) {
+                rest = &rest[len..];
+                continue;
+            }
+        }
+        cleaned.push(c);
+        chars += 1;
+        rest = &rest[c.len_utf8()..];
+    }
+
+    // Keep the original (truncated) text if it was nothing but mentions/emoji
+    if cleaned.trim().is_empty() {
+        return text.chars().take(MAX_EMBED_CHARS).collect();
+    }
+    cleaned
+}
+
+// Byte length of a mention or custom emoji at the start of `text`, if there is one
+fn discord_markup_len(text: &str) -> Option<usize> {
+    let body = text.strip_prefix('<')?;
+    let digits = if let Some(mention) = body.strip_prefix('@') {
+        mention.strip_prefix(|c| c == '!' || c == '&').unwrap_or(mention)
+    } else if let Some(channel) = body.strip_prefix('#') {
+        channel
     } else {
-        warn!("No text in Cohere summary response: {body:?}");
-        Err("No summary text found".into())
+        let emoji = body.strip_prefix("a:").or_else(|| body.strip_prefix(':'))?;
+        let name_len = emoji.find(|c: char| !(c.is_ascii_alphanumeric() || c == '_'))?;
+        if name_len == 0 {
+            return None;
+        }
+        emoji[name_len..].strip_prefix(':')?
+    };
+
+    let id_len = digits.find(|c: char| !c.is_ascii_digit())?;
+    if id_len == 0 || !digits[id_len..].starts_with('>') {
+        return None;
     }
+    Some(text.len() - digits.len() + id_len + 1)
 }
 
-pub async fn generate_response_from_chunks(cfg: &Config, query: &str, context_chunks: &[ChunkQueryResult]) -> Result<String, DynErr> {
-    let client = Client::new();
-
-    let context = context_chunks
-        .iter()
-        .map(|chunk| {
-            let authors_str = chunk.authors.join(", ");
-            let time_range = if chunk.first_timestamp == chunk.last_timestamp {
-                format!("at {}", chunk.first_timestamp)
-            } else {
-                format!("from {} to {}", chunk.first_timestamp, chunk.last_timestamp)
-            };
-
-            format!("[Speaker: {}] {}: {}",
-                    authors_str, time_range, chunk.text)
-        })
-        .collect::<Vec<_>>()
-        .join("\n\n");
+// Each preamble is a head and a tail with the request's context spliced in between
 
-    let res = client
-        .post("https://api.cohere.ai/v1/chat")
-        .bearer_auth(&cfg.cohere_key)
-        .json(&json!({
-            "model": "command-r-08-2024",
-            "message": query,
-            "preamble": format!(
-                "You are a helpful assistant that answers questions using ONLY the Discord conversation excerpts provided below.
+const RESPONSE_PREAMBLE_HEAD: &str = "You are a helpful assistant that answers questions based on Discord message history. \
+    Here are some relevant messages from the conversation:\n\n";
+const RESPONSE_PREAMBLE_TAIL: &str = "\n\n\
+    Please provide a helpful answer based on the context above. If the context doesn't contain \
+    enough information to answer the question, say so.";
+
+const SUMMARY_MESSAGE: &str = "Please provide a concise summary of this Discord conversation in 2-3 sentences.";
+const SUMMARY_PREAMBLE_HEAD: &str = "You are a helpful assistant that summarizes Discord conversations. \
+    Here is the conversation to summarize:\n\n";
+const SUMMARY_PREAMBLE_TAIL: &str = "\n\n\
+    Focus on the main topics discussed and key information shared.";
+
+const CHUNK_PREAMBLE_HEAD: &str = "You are a helpful assistant that answers questions using ONLY the Discord conversation excerpts provided below.
 
                 CONTEXT
-                {}
+                ";
+const CHUNK_PREAMBLE_TAIL: &str = "
 
                 GUIDELINES
                 1) Attribution & names
@@ -171,26 +344,141 @@ pub async fn generate_response_from_chunks(cfg: &Config, query: &str, context_ch
 
                 OUTPUT
                 - Provide the best possible answer grounded in the CONTEXT.
-                - Do not disclose user IDs. Do not include this instruction block in your reply.",
-                context
-            ),
-            "max_tokens": 300,
-            "temperature": 0.7
+                - Do not disclose user IDs. Do not include this instruction block in your reply.";
+
+pub async fn generate_response(cfg: &Config, query: &str, context_messages: &[QueryResult]) -> Result<String, DynErr> {
+    let context = message_context(context_messages);
+    let preamble = build_preamble(RESPONSE_PREAMBLE_HEAD, &context, RESPONSE_PREAMBLE_TAIL);
+
+    let response = chat(cfg, query, &preamble, 300, 0.7).await?;
+    info!(len = response.len(), "Generated response");
+    Ok(response)
+}
+
+pub async fn generate_summary(cfg: &Config, text: &str) -> Result<String, DynErr> {
+    let preamble = build_preamble(SUMMARY_PREAMBLE_HEAD, text, SUMMARY_PREAMBLE_TAIL);
+
+    let summary = chat(cfg, SUMMARY_MESSAGE, &preamble, 150, 0.3).await?;
+    info!(len = summary.len(), "Generated summary");
+    Ok(summary)
+}
+
+pub async fn generate_response_from_chunks(cfg: &Config, query: &str, context_chunks: &[ChunkQueryResult]) -> Result<String, DynErr> {
+    let context = chunk_context(context_chunks);
+    let preamble = build_preamble(CHUNK_PREAMBLE_HEAD, &context, CHUNK_PREAMBLE_TAIL);
+
+    let response = chat(cfg, query, &preamble, 300, 0.7).await?;
+    info!(len = response.len(), "Generated response from chunks");
+    Ok(response)
+}
+
+fn build_preamble(head: &str, context: &str, tail: &str) -> String {
+    let mut preamble = String::with_capacity(head.len() + context.len() + tail.len());
+    preamble.push_str(head);
+    preamble.push_str(context);
+    preamble.push_str(tail);
+    preamble
+}
+
+fn message_context(messages: &[QueryResult]) -> String {
+    let mut context = String::with_capacity(messages.iter().map(|msg| msg.text.len() + 3).sum());
+    for (i, msg) in messages.iter().enumerate() {
+        if i > 0 {
+            context.push('\n');
+        }
+        context.push_str("- ");
+        context.push_str(&msg.text);
+    }
+    context
+}
+
+fn chunk_context(chunks: &[ChunkQueryResult]) -> String {
+    use std::fmt::Write;
+
+    let mut context = String::with_capacity(chunks.iter().map(|chunk| chunk.text.len() + 128).sum());
+    for (i, chunk) in chunks.iter().enumerate() {
+        if i > 0 {
+            context.push_str("\n\n");
+        }
+        let _ = write!(context, "[Speaker: {}] ", chunk.authors.join(", "));
+        if chunk.first_timestamp == chunk.last_timestamp {
+            let _ = write!(context, "at {}", chunk.first_timestamp);
+        } else {
+            let _ = write!(context, "from {} to {}", chunk.first_timestamp, chunk.last_timestamp);
+        }
+        context.push_str(": ");
+        context.push_str(&chunk.text);
+    }
+    context
+}
+
+/// Send one message with a preamble to the Cohere chat endpoint and return the trimmed reply.
+async fn chat(cfg: &Config, message: &str, preamble: &str, max_tokens: u32, temperature: f64) -> Result<String, DynErr> {
+    let client = &*HTTP_CLIENT;
+
+    let res = client
+        .post("https://api.cohere.ai/v1/chat")
+        .bearer_auth(&cfg.cohere_key)
+        .json(&json!({
+            "model": "command-r-08-2024",
+            "message": message,
+            "preamble": preamble,
+            "max_tokens": max_tokens,
+            "temperature": temperature
         }))
         .send()
         .await?;
 
     if !res.status().is_success() {
-        return Err(format!("Cohere generate error: {}", res.text().await?).into());
+        return Err(format!("Cohere chat error: {}", res.text().await?).into());
     }
 
     let body: serde_json::Value = res.json().await?;
-    if let Some(text) = body["text"].as_str() {
-        let response = text.trim().to_string();
-        info!(len = response.len(), "Generated response from chunks");
-        Ok(response)
-    } else {
-        warn!("No text in Cohere response: {body:?}");
-        Err("No generated text found".into())
+    match body["text"].as_str() {
+        Some(text) => Ok(text.trim().to_string()),
+        None => {
+            warn!("No text in Cohere response: {body:?}");
+            Err("No generated text found".into())
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn strips_each_markup_form() {
+        for markup in ["<@123>", "<@!123>", "<@&123>", "<#123>", "<:wave:123>", "<a:wave_2:123>"] {
+            assert_eq!(discord_markup_len(&format!("{markup} rest")), Some(markup.len()));
+            assert_eq!(prepare_embed_input(&format!("hi {markup}there")), "hi there");
+        }
+    }
+
+    #[test]
+    fn keeps_malformed_markup() {
+        let malformed = [
+            "<@>", "<@abc>", "<@123", "<#>", "<::123>", "<:name:>", "<:na me:123>", "<b:name:123>", "a < b", "<",
+        ];
+        for text in malformed {
+            assert_eq!(discord_markup_len(text), None, "{text}");
+            assert_eq!(prepare_embed_input(text), text);
+        }
+    }
+
+    #[test]
+    fn caps_multibyte_text_on_char_boundaries() {
+        let text = format!("<@1>{}", "日本".repeat(MAX_EMBED_CHARS));
+        let prepared = prepare_embed_input(&text);
+        assert_eq!(prepared.chars().count(), MAX_EMBED_CHARS);
+        assert!(prepared.chars().all(|c| c == '日' || c == '本'));
+    }
+
+    #[test]
+    fn markup_only_text_falls_back_to_raw() {
+        assert_eq!(prepare_embed_input("<@123> <:wave:456>"), "<@123> <:wave:456>");
+
+        let long = "<@123> ".repeat(MAX_EMBED_CHARS);
+        assert_eq!(prepare_embed_input(&long).chars().count(), MAX_EMBED_CHARS);
     }
 }
@@ -1,4 +1,13 @@
 use std::env;
+use crate::{cohere::MAX_EMBED_BATCH, chunking::MIN_CHUNK_SIZE};
+
+/// Which service computes embeddings.
+#[derive(Clone, Copy, Debug, PartialEq)]
+pub enum EmbedBackend {
+    Cohere,
+    /// Self-hosted Text Embeddings Inference server at TEI_URL
+    Tei,
+}
 
 #[derive(Clone)]
 pub struct Config {
@@ -6,16 +15,26 @@ pub struct Config {
     pub cohere_key: String,
     pub pinecone_key: String,
     pub pinecone_host: String,
+    // Derived from pinecone_host
+    pub pinecone_query_url: String,
+    pub pinecone_upsert_url: String,
     pub pinecone_index: String,
     pub namespace: String,
     pub kafka_brokers: String,
     pub kafka_group_id: String,
     pub elasticsearch_url: String,
     pub elasticsearch_index: String,
+    pub embed_batch_size: usize,
+    pub embed_backend: EmbedBackend,
+    pub tei_embed_url: String,
+    pub chunk_max_messages: usize,
 }
 
 impl Config {
     pub fn from_env() -> Self {
+        let pinecone_host = env::var("PINECONE_HOST")
+            .expect("Expected PINECONE_HOST in env");
+
         Self {
             discord_token: env::var("DISCORD_TOKEN")
                 .expect("Expected DISCORD_TOKEN in env"),
@@ -23,8 +42,9 @@ impl Config {
                 .expect("Expected COHERE_API_KEY in env"),
             pinecone_key: env::var("PINECONE_API_KEY")
                 .expect("Expected PINECONE_API_KEY in env"),
-            pinecone_host: env::var("PINECONE_HOST")
-                .expect("Expected PINECONE_HOST in env"),
+            pinecone_query_url: format!("{}/query", pinecone_host),
+            pinecone_upsert_url: format!("{}/vectors/upsert", pinecone_host),
+            pinecone_host,
             pinecone_index: env::var("PINECONE_INDEX")
                 .expect("Expected PINECONE_INDEX in env"),
             namespace: env::var("PINECONE_NAMESPACE")
@@ -37,6 +57,24 @@ impl Config {
                 .unwrap_or_else(|_| "http://localhost:9200".into()),
             elasticsearch_index: env::var("ELASTICSEARCH_INDEX")
                 .unwrap_or_else(|_| "discord-messages".into()),
+            embed_batch_size: env::var("EMBED_BATCH_SIZE")
+                .ok()
+                .and_then(|v| v.parse().ok())
+                .unwrap_or(MAX_EMBED_BATCH)
+                .clamp(1, MAX_EMBED_BATCH),
+            embed_backend: match env::var("EMBED_BACKEND").unwrap_or_default().to_lowercase().as_str() {
+                "tei" => EmbedBackend::Tei,
+                _ => EmbedBackend::Cohere,
+            },
+            tei_embed_url: format!(
+                "{}/embed",
+                env::var("TEI_URL").unwrap_or_else(|_| "http://localhost:8082".into())
+            ),
+            chunk_max_messages: env::var("CHUNK_MAX_MESSAGES")
+                .ok()
+                .and_then(|v| v.parse().ok())
+                .unwrap_or(12)
+                .clamp(MIN_CHUNK_SIZE, 100),
         }
     }
 }
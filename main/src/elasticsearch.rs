@@ -1,7 +1,7 @@
 use reqwest::Client;
 use serde_json::{json, Value};
 use tracing::{info, error, warn};
-use crate::{config::Config, schema::MessageEvent};
+use crate::{config::Config, schema::MessageEvent, http_client::HTTP_CLIENT, metrics::ELASTICSEARCH_INDEX_DURATION};
 
 type DynErr = Box<dyn std::error::Error + Send + Sync>;
 
@@ -9,6 +9,9 @@ pub struct ElasticsearchClient {
     client: Client,
     base_url: String,
     index_name: String,
+    index_url: String,
+    bulk_url: String,
+    search_url: String,
 }
 
 #[derive(Debug, Clone)]
@@ -23,12 +26,16 @@ pub struct ESQueryResult {
 
 impl ElasticsearchClient {
     pub async fn new(cfg: &Config) -> Result<Self, DynErr> {
-        let client = Client::new();
+        let client = HTTP_CLIENT.clone();
         let base_url = cfg.elasticsearch_url.clone();
         let index_name = cfg.elasticsearch_index.clone();
-        
+        let index_url = format!("{}/{}", base_url, index_name);
+
         let es_client = Self {
             client,
+            bulk_url: format!("{}/_bulk", index_url),
+            search_url: format!("{}/_search", index_url),
+            index_url,
             base_url,
             index_name,
         };
@@ -40,16 +47,6 @@ impl ElasticsearchClient {
     }
 
     async fn create_index(&self) -> Result<(), DynErr> {
-        let url = format!("{}/{}", self.base_url, self.index_name);
-        
-        // Check if index exists
-        let response = self.client.head(&url).send().await?;
-        
-        if response.status().is_success() {
-            info!("ElasticSearch index already exists");
-            return Ok(());
-        }
-        
         info!("Creating ElasticSearch index: {}", self.index_name);
         
         let body = json!({
@@ -89,6 +86,13 @@ impl ElasticsearchClient {
             "settings": {
                 "number_of_shards": 1,
                 "number_of_replicas": 0,
+                // Store documents sorted by the fields every search filters on, so a
+                // guild/channel's messages sit together on disk, newest first. Index sort
+                // can only be set at creation, so existing indexes keep their layout.
+                "index": {
+                    "sort.field": ["guild_id", "channel_id", "timestamp"],
+                    "sort.order": ["asc", "asc", "desc"]
+                },
                 "analysis": {
                     "analyzer": {
                         "standard": {
@@ -101,7 +105,7 @@ impl ElasticsearchClient {
         });
 
         let response = self.client
-            .put(&url)
+            .put(&self.index_url)
             .json(&body)
             .send()
             .await?;
@@ -110,6 +114,10 @@ impl ElasticsearchClient {
             info!("ElasticSearch index created successfully");
         } else {
             let error_text = response.text().await?;
+            if error_text.contains("resource_already_exists_exception") {
+                info!("ElasticSearch index already exists");
+                return Ok(());
+            }
             error!("Failed to create index: {}", error_text);
             return Err("Failed to create ElasticSearch index".into());
         }
@@ -118,17 +126,9 @@ impl ElasticsearchClient {
     }
 
     pub async fn index_message(&self, message: &MessageEvent) -> Result<(), DynErr> {
-        let url = format!("{}/{}/_doc/{}", self.base_url, self.index_name, message.id);
+        let url = format!("{}/_doc/{}", self.index_url, message.id);
         
-        let doc = json!({
-            "message_id": message.id,
-            "guild_id": message.guild_id,
-            "channel_id": message.channel_id,
-            "author_id": message.author_id,
-            "text": message.text,
-            "timestamp": message.timestamp,
-            "created_at": chrono::Utc::now().to_rfc3339()
-        });
+        let doc = Self::message_document(message, &chrono::Utc::now().to_rfc3339());
 
         let response = self.client
             .put(&url)
@@ -146,8 +146,85 @@ impl ElasticsearchClient {
         Ok(())
     }
 
+    pub async fn index_messages(&self, messages: &[MessageEvent]) -> Result<(), DynErr> {
+        if messages.is_empty() {
+            return Ok(());
+        }
+
+        let _timer = ELASTICSEARCH_INDEX_DURATION.start_timer();
+
+        // Bulk API body is NDJSON: an action line followed by the document for each message.
+        // One created_at timestamp is formatted for the whole batch.
+        let created_at = chrono::Utc::now().to_rfc3339();
+        let mut body = String::new();
+        for message in messages {
+            body.push_str(&json!({ "index": { "_id": message.id } }).to_string());
+            body.push('\n');
+            body.push_str(&Self::message_document(message, &created_at).to_string());
+            body.push('\n');
+        }
+
+        let response = self.client
+            .post(&self.bulk_url)
+            .header("Content-Type", "application/x-ndjson")
+            .body(body)
+            .send()
+            .await?;
+
+        if !response.status().is_success() {
+            let error_text = response.text().await?;
+            error!(count = messages.len(), "Failed to bulk index messages to ElasticSearch: {}", error_text);
+            return Err("ElasticSearch bulk index failed".into());
+        }
+
+        let response_body: Value = response.json().await?;
+        if response_body["errors"].as_bool().unwrap_or(false) {
+            let failed = response_body["items"]
+                .as_array()
+                .map(|items| items.iter().filter(|item| item["index"]["error"].is_object()).count())
+                .unwrap_or(0);
+            error!(count = messages.len(), failed, "Some messages failed to bulk index to ElasticSearch");
+        } else {
+            info!(count = messages.len(), "Bulk indexed messages to ElasticSearch");
+        }
+
+        Ok(())
+    }
+
+    /// Set the index refresh interval; `Some("-1")` pauses refreshes during bulk loads and
+    /// `None` restores the ElasticSearch default.
+    pub async fn set_refresh_interval(&self, interval: Option<&str>) -> Result<(), DynErr> {
+        let url = format!("{}/_settings", self.index_url);
+
+        let response = self.client
+            .put(&url)
+            .json(&json!({ "index": { "refresh_interval": interval } }))
+            .send()
+            .await?;
+
+        if !response.status().is_success() {
+            let error_text = response.text().await?;
+            return Err(format!("Failed to update refresh interval: {}", error_text).into());
+        }
+
+        info!(refresh_interval = ?interval, "Updated ElasticSearch refresh interval");
+        Ok(())
+    }
+
+    fn message_document(message: &MessageEvent, created_at: &str) -> Value {
+        json!({
+            "message_id": message.id,
+            "guild_id": message.guild_id,
+            "channel_id": message.channel_id,
+            "author_id": message.author_id,
+            "text": message.text,
+            "timestamp": message.timestamp,
+            "created_at": created_at
+        })
+    }
+
     pub async fn delete_message(&self, message_id: &str) -> Result<(), DynErr> {
-        let url = format!("{}/{}/_doc/{}", self.base_url, self.index_name, message_id);
+        let url = format!("{}/_doc/{}", self.index_url, message_id);
         
         let response = self.client
             .delete(&url)
@@ -174,51 +251,35 @@ impl ElasticsearchClient {
         author_id: Option<&str>,
         limit: usize,
     ) -> Result<Vec<ESQueryResult>, DynErr> {
-        let url = format!("{}/{}/_search", self.base_url, self.index_name);
-        
-        let mut must_clauses = vec![
-            json!({
-                "multi_match": {
-                    "query": query,
-                    "fields": ["text^2", "text.raw"],
-                    "type": "best_fields",
-                    "fuzziness": "AUTO"
-                }
-            })
-        ];
-
-        // Add filters
-        if let Some(guild_id) = guild_id {
-            must_clauses.push(json!({
-                "term": {
-                    "guild_id": guild_id
-                }
-            }));
-        }
-
-        if let Some(channel_id) = channel_id {
-            must_clauses.push(json!({
-                "term": {
-                    "channel_id": channel_id
-                }
-            }));
-        }
+        let text_query = json!({
+            "multi_match": {
+                "query": query,
+                "fields": ["text^2", "text.raw"],
+                "type": "best_fields",
+                "fuzziness": "AUTO"
+            }
+        });
 
-        if let Some(author_id) = author_id {
-            must_clauses.push(json!({
-                "term": {
-                    "author_id": author_id
-                }
-            }));
-        }
+        // Exact-match filters go in filter context: they don't affect scoring and
+        // ElasticSearch can cache them across queries
+        let filter_clauses = term_filters(&[
+            ("guild_id", guild_id),
+            ("channel_id", channel_id),
+            ("author_id", author_id),
+        ]);
 
         let search_body = json!({
             "query": {
                 "bool": {
-                    "must": must_clauses
+                    "must": [text_query],
+                    "filter": filter_clauses
                 }
             },
+            // Only return the fields we read back
+            "_source": ["text", "author_id", "channel_id", "timestamp", "guild_id"],
             "size": limit,
+            // We never read hits.total, so skip counting every matching document
+            "track_total_hits": false,
             "sort": [
                 { "_score": { "order": "desc" } },
                 { "timestamp": { "order": "desc" } }
@@ -226,7 +287,7 @@ impl ElasticsearchClient {
         });
 
         let response = self.client
-            .post(&url)
+            .post(&self.search_url)
             .json(&search_body)
             .send()
             .await?;
@@ -276,4 +337,13 @@ impl ElasticsearchClient {
 
         Ok(response.status().is_success())
     }
-}
\ No newline at end of file
+}
+
+// One `term` clause per filter that is set; values are passed as JSON strings, never
+// spliced into query text
+fn term_filters(filters: &[(&str, Option<&str>)]) -> Vec<Value> {
+    filters
+        .iter()
+        .filter_map(|&(field, value)| Some(json!({ "term": { field: value? } })))
+        .collect()
+}
@@ -5,25 +5,57 @@ use serenity::{
     builder::{CreateCommand, CreateCommandOption},
     all::{CreateInteractionResponse, CreateInteractionResponseMessage, CreateInteractionResponseFollowup, Interaction, CommandOptionType},
 };
+use std::hash::{Hash, Hasher};
+use std::sync::Arc;
+use std::time::Duration;
 use tracing::{info, error, warn};
-use tokio::sync::Mutex;
+use tokio::sync::{Mutex, Semaphore};
 use crate::{
     config::Config,
     schema::MessageEvent,
     cohere::{get_embedding, generate_response, generate_response_from_chunks},
-    pinecone::{upsert_to_pinecone, query_pinecone, query_chunks_pinecone},
-    chunking::ChunkManager,
+    pinecone::{query_pinecone, query_chunks_pinecone},
+    chunking::{ChunkManager, process_chunks},
     kafka_producer::KafkaProducer,
     kafka_types::KafkaMessage,
     elasticsearch::ElasticsearchClient,
+    pipeline::EmbedPipeline,
+    cache::{GuildVersions, SemanticCache, TtlCache},
     metrics::{MESSAGES_PROCESSED, MESSAGES_FAILED, MESSAGE_PROCESSING_DURATION, SEARCH_REQUESTS, SEARCH_DURATION},
 };
 
+// Chunk batches being summarized/embedded/upserted at once outside the chunk manager lock
+const MAX_CONCURRENT_CHUNK_BATCHES: usize = 4;
+
+const RESPONSE_CACHE_CAPACITY: usize = 10_000;
+const RESPONSE_CACHE_TTL: Duration = Duration::from_secs(300);
+// Guilds whose content version is tracked; the least recently updated are evicted
+const GUILD_VERSIONS_CAPACITY: usize = 10_000;
+// Messages sent through Kafka are indexed by the consumer and indexer services, which the
+// bot can't observe, so answers for a guild aren't cached until it has been this quiet
+const KAFKA_INDEX_LAG: Duration = Duration::from_secs(30);
+
+// Questions whose embeddings are at least this cosine-similar share a cached answer
+const SEMANTIC_CACHE_CAPACITY: usize = 1024;
+const SEMANTIC_CACHE_THRESHOLD: f32 = 0.95;
+
+// (guild, guild content version, channel filter, author filter)
+type ResponseScope = (Option<String>, u64, Option<String>, Option<String>);
+// (scope, fingerprint of the normalized question)
+type ResponseCacheKey = (ResponseScope, u64);
+
 pub struct Handler {
     pub cfg: Config,
     pub chunk_manager: Mutex<ChunkManager>,
+    pub chunk_permits: Semaphore,
     pub kafka_producer: Option<KafkaProducer>,
     pub es_client: Option<ElasticsearchClient>,
+    pub embed_pipeline: EmbedPipeline,
+    pub response_cache: std::sync::Mutex<TtlCache<ResponseCacheKey, String>>,
+    pub semantic_cache: std::sync::Mutex<SemanticCache<ResponseScope, String>>,
+    // Bumped for every message ingested in a guild (None for DMs), so cached answers for
+    // a guild stop matching as soon as new history could change them
+    pub guild_versions: Arc<std::sync::Mutex<GuildVersions>>,
 }
 
 #[async_trait]
@@ -135,18 +167,20 @@ impl EventHandler for Handler {
 
     async fn message(&self, _ctx: Context, msg: Message) {
         if msg.author.bot { return; }
+        // Attachment/sticker-only messages have no text to embed or search
+        if msg.content.trim().is_empty() { return; }
 
         let _timer = MESSAGE_PROCESSING_DURATION.start_timer();
         let correlation_id = uuid::Uuid::new_v4().to_string();
         let guild_id = msg.guild_id.map(|id| id.to_string());
-        
+
         let event = MessageEvent {
             id: msg.id.to_string(),
             guild_id: guild_id.clone(),
             channel_id: msg.channel_id.to_string(),
             author_id: msg.author.id.to_string(),
-            timestamp: msg.timestamp.to_rfc3339().unwrap_or_else(|| "".to_string()),
-            text: msg.content.clone(),
+            timestamp: msg.timestamp.to_rfc3339().unwrap_or_default(),
+            text: msg.content,
         };
 
         info!(
@@ -168,6 +202,9 @@ impl EventHandler for Handler {
                 self.process_message_directly(event).await;
             } else {
                 MESSAGES_PROCESSED.inc();
+                // Invalidate answers cached before this message; KAFKA_INDEX_LAG keeps new
+                // ones from being cached until the services have had time to index it
+                self.guild_versions.lock().unwrap().bump(&guild_id);
             }
         } else {
             // Process directly without Kafka
@@ -191,11 +228,19 @@ impl Handler {
             }
         };
         
+        let guild_versions = Arc::new(std::sync::Mutex::new(GuildVersions::new(GUILD_VERSIONS_CAPACITY)));
+        let embed_pipeline = EmbedPipeline::spawn(Arc::new(cfg.clone()), Some(guild_versions.clone()));
+
         Ok(Self {
             cfg,
             chunk_manager: Mutex::new(ChunkManager::new()),
+            chunk_permits: Semaphore::new(MAX_CONCURRENT_CHUNK_BATCHES),
             kafka_producer,
             es_client: None, // Will be initialized asynchronously
+            embed_pipeline,
+            response_cache: std::sync::Mutex::new(TtlCache::new(RESPONSE_CACHE_CAPACITY, RESPONSE_CACHE_TTL)),
+            semantic_cache: std::sync::Mutex::new(SemanticCache::new(SEMANTIC_CACHE_CAPACITY, SEMANTIC_CACHE_THRESHOLD)),
+            guild_versions,
         })
     }
 
@@ -222,42 +267,50 @@ impl Handler {
         let _timer = SEARCH_DURATION.start_timer();
         SEARCH_REQUESTS.inc();
         // Get Pinecone results (semantic search)
-        let pinecone_results = if let Some(guild_id) = guild_id {
-            let embedding = get_embedding(&self.cfg, query).await?;
-            query_chunks_pinecone(
-                &self.cfg,
-                embedding,
-                5,
-                Some(guild_id.to_string()),
-            ).await?
-        } else {
-            vec![]
+        let semantic = async {
+            if let Some(guild_id) = guild_id {
+                let embedding = get_embedding(&self.cfg, query).await?;
+                query_chunks_pinecone(
+                    &self.cfg,
+                    &embedding,
+                    5,
+                    Some(guild_id),
+                ).await
+            } else {
+                Ok(vec![])
+            }
         };
 
         // Get ElasticSearch results (keyword search)
-        let es_results = if let Some(ref es_client) = self.es_client {
-            es_client.search_messages(query, guild_id, channel_id, author_id, 5).await?
-        } else {
-            vec![]
+        let keyword = async {
+            if let Some(ref es_client) = self.es_client {
+                es_client.search_messages(query, guild_id, channel_id, author_id, 5).await
+            } else {
+                Ok(vec![])
+            }
         };
 
+        // The two searches are independent, so run them concurrently
+        let (pinecone_results, es_results) = tokio::try_join!(semantic, keyword)?;
+
         // Combine and merge results
-        let combined_results = self.merge_search_results(pinecone_results, es_results, 0.65).await?;
+        // Keep everything both sources returned (5 each) as context
+        let combined_results = self.merge_search_results(pinecone_results, es_results, 0.65, 10).await?;
         
         if combined_results.is_empty() {
             return Ok("I couldn't find any relevant information about that topic.".to_string());
         }
 
         // Generate response from combined results
-        let context_chunks: Vec<crate::schema::ChunkQueryResult> = combined_results.iter()
+        let context_chunks: Vec<crate::schema::ChunkQueryResult> = combined_results.into_iter()
             .map(|result| crate::schema::ChunkQueryResult {
                 chunk_id: result.text.clone(),
-                text: result.text.clone(),
+                text: result.text,
                 summary: None,
-                authors: vec![result.author_id.clone()],
+                authors: vec![result.author_id],
                 message_count: 1,
                 first_timestamp: result.timestamp.clone(),
-                last_timestamp: result.timestamp.clone(),
+                last_timestamp: result.timestamp,
                 score: result.score,
             })
             .collect();
@@ -270,26 +323,29 @@ impl Handler {
         pinecone_results: Vec<crate::schema::ChunkQueryResult>,
         es_results: Vec<crate::elasticsearch::ESQueryResult>,
         alpha: f64,
+        top_k: usize,
     ) -> Result<Vec<crate::elasticsearch::ESQueryResult>, Box<dyn std::error::Error + Send + Sync>> {
-        use std::collections::HashMap;
-        
-        let mut combined_scores: HashMap<String, (f64, crate::elasticsearch::ESQueryResult)> = HashMap::new();
-        
+        use std::collections::{hash_map::Entry, HashMap};
+
+        // Keyed by a 64-bit fingerprint of the result text
+        let mut combined_scores: HashMap<u64, (f64, crate::elasticsearch::ESQueryResult)> =
+            HashMap::with_capacity(pinecone_results.len() + es_results.len());
+
         // Add Pinecone results (normalize scores to 0-1)
         for result in pinecone_results {
             let normalized_score = (result.score + 1.0) / 2.0; // Convert from [-1,1] to [0,1]
             let final_score = alpha * normalized_score;
             
             let es_result = crate::elasticsearch::ESQueryResult {
-                text: result.text.clone(),
-                author_id: result.authors.first().unwrap_or(&"unknown".to_string()).clone(),
+                text: result.text,
+                author_id: result.authors.into_iter().next().unwrap_or_else(|| "unknown".to_string()),
                 channel_id: "unknown".to_string(), // ChunkQueryResult doesn't have channel_id
-                timestamp: result.first_timestamp.clone(),
+                timestamp: result.first_timestamp,
                 guild_id: None, // ChunkQueryResult doesn't have guild_id
                 score: final_score,
             };
             
-            combined_scores.insert(result.chunk_id, (final_score, es_result));
+            combined_scores.insert(content_fingerprint(&es_result.text), (final_score, es_result));
         }
         
         // Add ElasticSearch results
@@ -297,38 +353,61 @@ impl Handler {
             let normalized_score = result.score / 10.0; // Rough normalization
             let final_score = (1.0 - alpha) * normalized_score;
             
-            if let Some((existing_score, _)) = combined_scores.get(&result.text) {
-                // If we have both Pinecone and ES results for the same content, take the max
-                if final_score > *existing_score {
-                    combined_scores.insert(result.text.clone(), (final_score, result));
+            match combined_scores.entry(content_fingerprint(&result.text)) {
+                Entry::Occupied(mut existing) => {
+                    // If we have both Pinecone and ES results for the same content, take the max
+                    if final_score > existing.get().0 {
+                        existing.insert((final_score, result));
+                    }
+                }
+                Entry::Vacant(slot) => {
+                    slot.insert((final_score, result));
                 }
-            } else {
-                combined_scores.insert(result.text.clone(), (final_score, result));
             }
         }
         
-        // Sort by combined score and return top results
+        // Select the top_k by combined score in linear time, then sort just those
         let mut results: Vec<_> = combined_scores.into_values().collect();
-        results.sort_by(|a, b| b.0.partial_cmp(&a.0).unwrap_or(std::cmp::Ordering::Equal));
+        if results.len() > top_k {
+            if top_k == 0 {
+                return Ok(Vec::new());
+            }
+            results.select_nth_unstable_by(top_k - 1, |a, b| b.0.total_cmp(&a.0));
+            results.truncate(top_k);
+        }
+        results.sort_unstable_by(|a, b| b.0.total_cmp(&a.0));
         
         Ok(results.into_iter().map(|(_, result)| result).collect())
     }
 
     async fn process_message_directly(&self, event: MessageEvent) {
-        // Process message through chunking system
-        let mut chunk_manager = self.chunk_manager.lock().await;
-        if let Err(err) = chunk_manager.process_message(&self.cfg, event.clone()).await {
-            error!("Failed to process message through chunking: {err}");
-        }
+        // Keep individual message processing as fallback/compatibility; the pipeline
+        // embeds and upserts queued messages in batches on background tasks
+        self.embed_pipeline.submit(event.clone()).await;
 
-        // Keep individual message processing as fallback/compatibility
-        match get_embedding(&self.cfg, &event.text).await {
-            Ok(embedding) => {
-                if let Err(err) = upsert_to_pinecone(&self.cfg, &event, embedding).await {
-                    error!("Failed to upsert individual message: {err}");
-                }
+        // Only hold the chunk manager lock while buffering; the network work for any
+        // finished chunks runs after it is released so other messages aren't blocked
+        let chunks = match self.chunk_manager.lock().await.buffer_message(&self.cfg, event) {
+            Ok(chunks) => chunks,
+            Err(err) => {
+                error!("Failed to process message through chunking: {err}");
+                return;
             }
-            Err(err) => error!("Individual message embedding failed: {err}"),
+        };
+        if chunks.is_empty() {
+            return;
+        }
+
+        let guild_ids: Vec<Option<String>> = chunks.iter().map(|chunk| chunk.guild_id.clone()).collect();
+        let _permit = self.chunk_permits.acquire().await.expect("chunk semaphore is never closed");
+        if let Err(err) = process_chunks(&self.cfg, chunks).await {
+            error!("Failed to process chunks: {err}");
+        }
+
+        // The chunks are searchable now, so answers cached without them are stale
+        let mut versions = self.guild_versions.lock().unwrap();
+        for guild_id in &guild_ids {
+            versions.bump(guild_id);
         }
     }
 
@@ -346,18 +425,59 @@ impl Handler {
             info!("ElasticSearch client not initialized, using Pinecone-only search");
         }
 
+        // Repeated questions within the TTL skip embedding, retrieval and generation
+        // Versions are bumped once new messages are searchable, so an answer computed
+        // before then is stored under a version that no longer matches
+        let (version, cacheable) = {
+            let versions = self.guild_versions.lock().unwrap();
+            let settled = self.kafka_producer.is_none() || versions.settled(&guild_id, KAFKA_INDEX_LAG);
+            (versions.get(&guild_id), settled)
+        };
+        let scope = (
+            guild_id.clone(),
+            version,
+            channel_filter.map(str::to_string),
+            author_filter.clone(),
+        );
+        let cache_key = (scope.clone(), Self::question_fingerprint(question));
+        if let Some(response) = self.response_cache.lock().unwrap().get(&cache_key) {
+            info!("Serving /ask response from cache");
+            return Ok(response);
+        }
+
+        // Paraphrases of a recent question reuse its answer; the embedding is cached, so
+        // the search below doesn't embed the question again
+        let question_embedding = get_embedding(&self.cfg, question).await?;
+        if let Some(response) = self.semantic_cache.lock().unwrap().get(&scope, &question_embedding) {
+            info!("Serving /ask response from semantic cache");
+            self.response_cache.lock().unwrap().insert(cache_key, response.clone());
+            return Ok(response);
+        }
+
         // Use hybrid search if ES is available, otherwise fallback to Pinecone-only
-        if let Some(ref _es_client) = self.es_client {
+        let response = if let Some(ref _es_client) = self.es_client {
             self.hybrid_search(
                 question,
                 guild_id.as_deref(),
                 channel_filter,
                 author_filter.as_deref(),
-            ).await
+            ).await?
         } else {
             // Fallback to original Pinecone-only search
-            self.handle_ask_command(question, guild_id).await
+            self.handle_ask_command(question, guild_id).await?
+        };
+
+        if cacheable {
+            self.semantic_cache.lock().unwrap().insert(scope, question_embedding, response.clone());
+            self.response_cache.lock().unwrap().insert(cache_key, response.clone());
         }
+        Ok(response)
+    }
+
+    fn question_fingerprint(question: &str) -> u64 {
+        let mut hasher = std::collections::hash_map::DefaultHasher::new();
+        question.trim().to_lowercase().hash(&mut hasher);
+        hasher.finish()
     }
 
     async fn handle_ask_command(&self, question: &str, guild_id: Option<String>) -> Result<String, Box<dyn std::error::Error + Send + Sync>> {
@@ -366,9 +486,13 @@ impl Handler {
         info!("Getting embedding for question: {}", question);
         let question_embedding = get_embedding(&self.cfg, question).await?;
 
-        // First try to query chunks
-        info!("Querying Pinecone for similar chunks in guild: {:?}", guild_id);
-        let similar_chunks = query_chunks_pinecone(&self.cfg, question_embedding.clone(), 3, guild_id.clone()).await?;
+        // Chunks are preferred, with individual messages as the fallback; query both at
+        // once so the fallback doesn't cost a second sequential round trip
+        info!("Querying Pinecone for similar chunks and messages in guild: {:?}", guild_id);
+        let (similar_chunks, similar_messages) = tokio::try_join!(
+            query_chunks_pinecone(&self.cfg, &question_embedding, 3, guild_id.as_deref()),
+            query_pinecone(&self.cfg, &question_embedding, 5, guild_id.as_deref()),
+        )?;
 
         if !similar_chunks.is_empty() {
             info!("Found {} similar chunks, generating response", similar_chunks.len());
@@ -377,8 +501,7 @@ impl Handler {
         }
 
         // Fallback to individual messages
-        info!("No chunks found, querying individual messages in guild: {:?}", guild_id);
-        let similar_messages = query_pinecone(&self.cfg, question_embedding, 5, guild_id).await?;
+        info!("No chunks found, using individual messages in guild: {:?}", guild_id);
 
         if similar_messages.is_empty() {
             return Ok("I couldn't find any relevant messages in the history to answer your question.".to_string());
@@ -390,3 +513,9 @@ impl Handler {
         Ok(response)
     }
 }
+
+fn content_fingerprint(text: &str) -> u64 {
+    let mut hasher = std::collections::hash_map::DefaultHasher::new();
+    text.hash(&mut hasher);
+    hasher.finish()
+}
@@ -1,5 +1,6 @@
 use std::sync::Arc;
 use tokio::sync::Mutex;
+use crate::http_client::HTTP_CLIENT;
 
 #[derive(Debug, Clone, serde::Serialize)]
 pub struct HealthStatus {
@@ -78,7 +79,7 @@ impl HealthChecker {
     pub async fn check_elasticsearch(&self, es_url: &str) -> ServiceHealth {
         let start = std::time::Instant::now();
         
-        match reqwest::get(&format!("{}/_cluster/health", es_url)).await {
+        match HTTP_CLIENT.get(&format!("{}/_cluster/health", es_url)).send().await {
             Ok(response) => {
                 let response_time = start.elapsed().as_millis() as u64;
                 if response.status().is_success() {
@@ -112,7 +113,7 @@ impl HealthChecker {
         let start = std::time::Instant::now();
         
         // Simple Pinecone health check - try to make a basic request
-        match reqwest::get(&format!("{}/describe_index_stats", pinecone_host)).await {
+        match HTTP_CLIENT.get(&format!("{}/describe_index_stats", pinecone_host)).send().await {
             Ok(response) => {
                 let response_time = start.elapsed().as_millis() as u64;
                 if response.status().is_success() {
@@ -0,0 +1,24 @@
+use std::env;
+use std::time::Duration;
+use reqwest::Client;
+
+lazy_static::lazy_static! {
+    // Shared client so every Cohere, Pinecone and ElasticSearch call reuses pooled
+    // keep-alive connections (HTTP/2 is negotiated via ALPN where the server supports it).
+    // Pool size and timeouts can be tuned for the expected request concurrency.
+    pub static ref HTTP_CLIENT: Client = Client::builder()
+        .pool_max_idle_per_host(env_or("HTTP_POOL_MAX_IDLE_PER_HOST", 64))
+        .pool_idle_timeout(Duration::from_secs(env_or("HTTP_POOL_IDLE_TIMEOUT_SECS", 30)))
+        .connect_timeout(Duration::from_secs(env_or("HTTP_CONNECT_TIMEOUT_SECS", 10)))
+        .timeout(Duration::from_secs(env_or("HTTP_TIMEOUT_SECS", 60)))
+        .tcp_keepalive(Duration::from_secs(30))
+        .build()
+        .expect("Failed to build HTTP client");
+}
+
+fn env_or<T: std::str::FromStr>(key: &str, default: T) -> T {
+    env::var(key)
+        .ok()
+        .and_then(|v| v.parse().ok())
+        .unwrap_or(default)
+}
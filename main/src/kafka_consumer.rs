@@ -1,20 +1,27 @@
 use rdkafka::consumer::{Consumer, StreamConsumer};
 use rdkafka::{ClientConfig, Message};
-use serde_json;
+use std::sync::Arc;
+use tokio::sync::Semaphore;
 use tracing::{info, error, debug};
 use crate::{
     config::Config,
     kafka_types::KafkaMessage,
     cohere::{get_embedding, generate_response, generate_response_from_chunks},
-    pinecone::{upsert_to_pinecone, query_pinecone, query_chunks_pinecone},
+    pinecone::{query_pinecone, query_chunks_pinecone},
     chunking::ChunkManager,
+    pipeline::EmbedPipeline,
     metrics::{KAFKA_MESSAGES_RECEIVED, MESSAGES_PROCESSED, MESSAGES_FAILED},
 };
 
+// Query requests being answered at once in background tasks
+const MAX_CONCURRENT_QUERIES: usize = 8;
+
 pub struct KafkaConsumer {
     consumer: StreamConsumer,
-    cfg: Config,
+    cfg: Arc<Config>,
     chunk_manager: ChunkManager,
+    embed_pipeline: EmbedPipeline,
+    query_permits: Arc<Semaphore>,
 }
 
 impl KafkaConsumer {
@@ -31,10 +38,13 @@ impl KafkaConsumer {
             .set("heartbeat.interval.ms", "10000") // 10 seconds
             .create()?;
 
+        let cfg = Arc::new(cfg);
         Ok(Self {
             consumer,
+            embed_pipeline: EmbedPipeline::spawn(cfg.clone(), None),
             cfg,
             chunk_manager: ChunkManager::new(),
+            query_permits: Arc::new(Semaphore::new(MAX_CONCURRENT_QUERIES)),
         })
     }
 
@@ -101,24 +111,21 @@ impl KafkaConsumer {
 
     async fn handle_discord_message(&mut self, message: KafkaMessage) -> Result<(), Box<dyn std::error::Error + Send + Sync>> {
         if let crate::kafka_types::KafkaPayload::DiscordMessage(msg_event) = message.payload {
+            if msg_event.text.trim().is_empty() {
+                debug!(message_id = %msg_event.id, "Skipping message without text");
+                return Ok(());
+            }
             info!(message_id = %msg_event.id, "Processing Discord message from Kafka");
 
+            // Individual messages are embedded and upserted in batches by the pipeline rather
+            // than one task per message; the queue is in memory only, so a crash can lose at
+            // most the messages still waiting in it
+            self.embed_pipeline.submit(msg_event.clone()).await;
+
             // Process through chunking system
-            if let Err(err) = self.chunk_manager.process_message(&self.cfg, msg_event.clone()).await {
+            if let Err(err) = self.chunk_manager.process_message(&self.cfg, msg_event).await {
                 error!(error = %err, "Failed to process message through chunking");
             }
-
-            // Also process as individual message for fallback
-            match get_embedding(&self.cfg, &msg_event.text).await {
-                Ok(embedding) => {
-                    if let Err(err) = upsert_to_pinecone(&self.cfg, &msg_event, embedding).await {
-                        error!(error = %err, "Failed to upsert individual message");
-                    }
-                }
-                Err(err) => {
-                    error!(error = %err, "Failed to get embedding for individual message");
-                }
-            }
         }
         Ok(())
     }
@@ -127,29 +134,43 @@ impl KafkaConsumer {
         if let crate::kafka_types::KafkaPayload::QueryRequest { question, user_id, guild_id } = message.payload {
             info!(question = %question, user_id = %user_id, "Processing query request");
 
-            // This would typically send the response back to Discord
-            // For now, we'll just log that we processed it
-            match get_embedding(&self.cfg, &question).await {
-                Ok(embedding) => {
-                    // Query Pinecone for similar content
-                    let similar_chunks = query_chunks_pinecone(&self.cfg, embedding.clone(), 3, guild_id.clone()).await?;
-                    
-                    if !similar_chunks.is_empty() {
-                        let response = generate_response_from_chunks(&self.cfg, &question, &similar_chunks).await?;
-                        info!(response = %response, "Generated response from chunks");
-                    } else {
-                        let similar_messages = query_pinecone(&self.cfg, embedding, 5, guild_id).await?;
-                        if !similar_messages.is_empty() {
-                            let response = generate_response(&self.cfg, &question, &similar_messages).await?;
-                            info!(response = %response, "Generated response from messages");
-                        }
-                    }
+            // Answering waits seconds on the LLM, so run it off the consume loop; the permit
+            // bounds how many run at once and pauses consumption once they are all busy
+            let permit = self.query_permits.clone().acquire_owned().await?;
+            let cfg = self.cfg.clone();
+            tokio::spawn(async move {
+                let _permit = permit;
+                if let Err(err) = answer_query(&cfg, &question, guild_id.as_deref()).await {
+                    error!(error = %err, user_id = %user_id, "Failed to answer query request");
                 }
-                Err(err) => {
-                    error!(error = %err, "Failed to get embedding for query");
-                }
-            }
+            });
         }
         Ok(())
     }
 }
+
+async fn answer_query(cfg: &Config, question: &str, guild_id: Option<&str>) -> Result<(), Box<dyn std::error::Error + Send + Sync>> {
+    // This would typically send the response back to Discord
+    // For now, we'll just log that we processed it
+    match get_embedding(cfg, question).await {
+        Ok(embedding) => {
+            // Query Pinecone for similar chunks and messages in one round trip
+            let (similar_chunks, similar_messages) = tokio::try_join!(
+                query_chunks_pinecone(cfg, &embedding, 3, guild_id),
+                query_pinecone(cfg, &embedding, 5, guild_id),
+            )?;
+
+            if !similar_chunks.is_empty() {
+                let response = generate_response_from_chunks(cfg, question, &similar_chunks).await?;
+                info!(response = %response, "Generated response from chunks");
+            } else if !similar_messages.is_empty() {
+                let response = generate_response(cfg, question, &similar_messages).await?;
+                info!(response = %response, "Generated response from messages");
+            }
+        }
+        Err(err) => {
+            error!(error = %err, "Failed to get embedding for query");
+        }
+    }
+    Ok(())
+}
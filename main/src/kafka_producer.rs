@@ -1,6 +1,5 @@
 use rdkafka::producer::{FutureProducer, FutureRecord};
 use rdkafka::ClientConfig;
-use serde_json;
 use tracing::{info, error};
 use std::time::Duration;
 use crate::{config::Config, kafka_types::{KafkaMessage, DISCORD_MESSAGES_TOPIC}, metrics::KAFKA_MESSAGES_SENT};
@@ -19,6 +18,10 @@ impl KafkaProducer {
             .set("retries", "3")
             .set("acks", "all")
             .set("enable.idempotence", "true")
+            // Batch concurrent sends into fewer, compressed produce requests
+            .set("linger.ms", "5")
+            .set("batch.num.messages", "1000")
+            .set("compression.type", "lz4")
             .create()?;
 
         Ok(Self { producer })
@@ -10,3 +10,7 @@ pub mod kafka_consumer;
 pub mod elasticsearch;
 pub mod metrics;
 pub mod health;
+pub mod http_client;
+pub mod cache;
+pub mod pipeline;
+pub mod server;
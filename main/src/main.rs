@@ -1,6 +1,5 @@
 use dotenv::dotenv;
 use serenity::prelude::*;
-use tracing_subscriber;
 use Quiry::{config::Config, handler::Handler};
 
 #[tokio::main]
@@ -11,6 +10,12 @@ async fn main() {
     let cfg = Config::from_env();
 
     let intents = GatewayIntents::GUILD_MESSAGES | GatewayIntents::MESSAGE_CONTENT;
+    // Warm the embedding backend in the background while we connect to Discord
+    tokio::spawn({
+        let cfg = cfg.clone();
+        async move { Quiry::cohere::warm_up(&cfg).await }
+    });
+
     let mut handler = Handler::new(cfg).expect("Failed to create handler");
     
     // Initialize ElasticSearch client asynchronously
@@ -20,6 +20,14 @@ lazy_static::lazy_static! {
         HistogramOpts::new("quiry_embedding_generation_duration_seconds", "Time spent generating embeddings")
     ).unwrap();
     
+    pub static ref EMBEDDING_CACHE_HITS: Counter = Counter::with_opts(
+        Opts::new("quiry_embedding_cache_hits_total", "Total number of embeddings served from the in-process cache")
+    ).unwrap();
+    
+    pub static ref EMBEDDING_CACHE_MISSES: Counter = Counter::with_opts(
+        Opts::new("quiry_embedding_cache_misses_total", "Total number of embeddings not found in the in-process cache")
+    ).unwrap();
+    
     pub static ref PINECONE_UPSERT_DURATION: Histogram = Histogram::with_opts(
         HistogramOpts::new("quiry_pinecone_upsert_duration_seconds", "Time spent upserting to Pinecone")
     ).unwrap();
@@ -73,6 +81,8 @@ impl MetricsRegistry {
         registry.register(Box::new(MESSAGES_FAILED.clone())).unwrap();
         registry.register(Box::new(MESSAGE_PROCESSING_DURATION.clone())).unwrap();
         registry.register(Box::new(EMBEDDING_GENERATION_DURATION.clone())).unwrap();
+        registry.register(Box::new(EMBEDDING_CACHE_HITS.clone())).unwrap();
+        registry.register(Box::new(EMBEDDING_CACHE_MISSES.clone())).unwrap();
         registry.register(Box::new(PINECONE_UPSERT_DURATION.clone())).unwrap();
         registry.register(Box::new(ELASTICSEARCH_INDEX_DURATION.clone())).unwrap();
         registry.register(Box::new(DISCORD_API_DURATION.clone())).unwrap();
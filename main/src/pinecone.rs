@@ -1,147 +1,127 @@
-use reqwest::Client;
+use std::borrow::Cow;
+use serde::{Deserialize, Serialize};
 use serde_json::json;
 use tracing::{info, error};
-use crate::{config::Config, schema::{MessageEvent, QueryResult, MessageChunk, ChunkQueryResult}, metrics::PINECONE_UPSERT_DURATION};
+use crate::{config::Config, schema::{MessageEvent, QueryResult, MessageChunk, ChunkQueryResult}, metrics::PINECONE_UPSERT_DURATION, http_client::HTTP_CLIENT};
 
 type DynErr = Box<dyn std::error::Error + Send + Sync>;
 
+// Pinecone recommends at most 100 vectors per upsert request
+const UPSERT_BATCH_SIZE: usize = 100;
+
 pub async fn upsert_to_pinecone(cfg: &Config, msg: &MessageEvent, embedding: Vec<f32>) -> Result<(), DynErr> {
-    let _timer = PINECONE_UPSERT_DURATION.start_timer();
-    let url = format!("{}/vectors/upsert", cfg.pinecone_host);
-    let client = Client::new();
+    upsert_vectors(cfg, &[message_vector(msg, embedding)]).await?;
 
-    let res = client
-        .post(&url)
-        .header("Api-Key", &cfg.pinecone_key)
-        .json(&json!({
-            "namespace": cfg.namespace,
-            "vectors": [{
-                "id": msg.id,
-                "values": embedding,
-                "metadata": {
-                    "guild_id": msg.guild_id,
-                    "channel_id": msg.channel_id,
-                    "author_id": msg.author_id,
-                    "timestamp": msg.timestamp,
-                    "text": msg.text
-                }
-            }]
-        }))
-        .send()
-        .await?;
+    info!(msg_id=?msg.id, "Upserted to Pinecone");
+    Ok(())
+}
 
-    let status = res.status();
-    let body = res.text().await?;
+pub async fn upsert_messages_to_pinecone(cfg: &Config, msgs: &[MessageEvent], embeddings: Vec<Vec<f32>>) -> Result<(), DynErr> {
+    let vectors: Vec<_> = msgs
+        .iter()
+        .zip(embeddings)
+        .map(|(msg, embedding)| message_vector(msg, embedding))
+        .collect();
 
-    if !status.is_success() {
-        error!(status=?status, body=?body, "Pinecone upsert failed");
-        return Err(format!("Pinecone error: {status}").into());
-    }
+    futures::future::try_join_all(
+        vectors.chunks(UPSERT_BATCH_SIZE).map(|batch| upsert_vectors(cfg, batch))
+    ).await?;
 
-    info!(msg_id=?msg.id, "Upserted to Pinecone");
+    info!(count = msgs.len(), "Upserted messages to Pinecone");
     Ok(())
 }
 
-pub async fn query_pinecone(cfg: &Config, embedding: Vec<f32>, top_k: usize, guild_id: Option<String>) -> Result<Vec<QueryResult>, DynErr> {
-    let url = format!("{}/query", cfg.pinecone_host);
-    let client = Client::new();
+fn message_vector(msg: &MessageEvent, embedding: Vec<f32>) -> Vector<'_, MessageMetadata<'_>> {
+    Vector {
+        id: Cow::Borrowed(&msg.id),
+        values: embedding,
+        metadata: MessageMetadata {
+            guild_id: msg.guild_id.as_deref(),
+            channel_id: &msg.channel_id,
+            author_id: &msg.author_id,
+            timestamp: &msg.timestamp,
+            text: &msg.text,
+        },
+    }
+}
+
+pub async fn query_pinecone(cfg: &Config, embedding: &[f32], top_k: usize, guild_id: Option<&str>) -> Result<Vec<QueryResult>, DynErr> {
+    let client = &*HTTP_CLIENT;
 
-    let mut query = json!({
+    let query = json!({
         "namespace": cfg.namespace,
         "vector": embedding,
         "topK": top_k,
         "includeMetadata": true,
-        "includeValues": false
+        "includeValues": false,
+        "filter": {
+            "guild_id": guild_condition(guild_id)
+        }
     });
 
-    // Add guild_id filter if provided
-    if let Some(guild_id) = guild_id {
-        query["filter"] = json!({
-            "guild_id": {"$eq": guild_id}
-        });
-    } else {
-        // For DMs, filter for messages without guild_id (null values)
-        query["filter"] = json!({
-            "guild_id": {"$exists": false}
-        });
-    }
-
     let res = client
-        .post(&url)
+        .post(&cfg.pinecone_query_url)
         .header("Api-Key", &cfg.pinecone_key)
         .json(&query)
         .send()
         .await?;
 
     let status = res.status();
-    let body: serde_json::Value = res.json().await?;
-
     if !status.is_success() {
+        let body = res.text().await?;
         error!(status=?status, body=?body, "Pinecone query failed");
         return Err(format!("Pinecone query error: {status}").into());
     }
 
-    let empty_vec = vec![];
-    let matches = body["matches"].as_array().unwrap_or(&empty_vec);
-    let mut results = Vec::new();
-
-    for match_obj in matches {
-        let score = match_obj["score"].as_f64().unwrap_or(0.0);
-        let metadata = &match_obj["metadata"];
-
-        if let (Some(text), Some(author_id), Some(timestamp)) = (
-            metadata["text"].as_str(),
-            metadata["author_id"].as_str(),
-            metadata["timestamp"].as_str(),
-        ) {
-            results.push(QueryResult {
-                text: text.to_string(),
-                author_id: author_id.to_string(),
-                timestamp: timestamp.to_string(),
-                score,
-            });
-        }
-    }
+    let body: QueryResponse<MessageMatchMetadata> = res.json().await?;
+    let results: Vec<QueryResult> = body.matches
+        .into_iter()
+        .filter_map(|m| {
+            let metadata = m.metadata?;
+            Some(QueryResult {
+                text: metadata.text?,
+                author_id: metadata.author_id?,
+                timestamp: metadata.timestamp?,
+                score: m.score,
+            })
+        })
+        .collect();
 
     info!(count = results.len(), "Found similar messages");
     Ok(results)
 }
 
 pub async fn upsert_chunk_to_pinecone(cfg: &Config, chunk: &MessageChunk, embedding: Vec<f32>) -> Result<(), DynErr> {
-    let url = format!("{}/vectors/upsert", cfg.pinecone_host);
-    let client = Client::new();
-
-    let mut metadata = json!({
-        "type": "chunk",
-        "chunk_id": chunk.chunk_id,
-        "guild_id": chunk.guild_id,
-        "channel_id": chunk.channel_id,
-        "first_msg_id": chunk.first_msg_id,
-        "last_msg_id": chunk.last_msg_id,
-        "first_timestamp": chunk.first_timestamp,
-        "last_timestamp": chunk.last_timestamp,
-        "message_count": chunk.message_count,
-        "authors": chunk.authors,
-        "full_text": chunk.full_text,
-        "has_summary": chunk.has_summary
-    });
+    upsert_chunks_to_pinecone(cfg, std::slice::from_ref(chunk), vec![embedding]).await
+}
 
-    // Only include summary if it exists (avoid null values)
-    if let Some(ref summary) = chunk.summary {
-        metadata["summary"] = json!(summary);
-    }
+pub async fn upsert_chunks_to_pinecone(cfg: &Config, chunks: &[MessageChunk], embeddings: Vec<Vec<f32>>) -> Result<(), DynErr> {
+    let vectors: Vec<_> = chunks
+        .iter()
+        .zip(embeddings)
+        .map(|(chunk, embedding)| chunk_vector(chunk, embedding))
+        .collect();
+
+    // Send batches concurrently
+    futures::future::try_join_all(
+        vectors.chunks(UPSERT_BATCH_SIZE).map(|batch| upsert_vectors(cfg, batch))
+    ).await?;
+
+    info!(count = chunks.len(), "Upserted chunks to Pinecone");
+    Ok(())
+}
+
+async fn upsert_vectors<M: Serialize>(cfg: &Config, vectors: &[Vector<'_, M>]) -> Result<(), DynErr> {
+    let _timer = PINECONE_UPSERT_DURATION.start_timer();
+    let client = &*HTTP_CLIENT;
 
     let res = client
-        .post(&url)
+        .post(&cfg.pinecone_upsert_url)
         .header("Api-Key", &cfg.pinecone_key)
-        .json(&json!({
-            "namespace": cfg.namespace,
-            "vectors": [{
-                "id": format!("chunk_{}", chunk.chunk_id),
-                "values": embedding,
-                "metadata": metadata
-            }]
-        }))
+        .json(&UpsertRequest {
+            namespace: &cfg.namespace,
+            vectors,
+        })
         .send()
         .await?;
 
@@ -149,102 +129,181 @@ pub async fn upsert_chunk_to_pinecone(cfg: &Config, chunk: &MessageChunk, embedd
     let body = res.text().await?;
 
     if !status.is_success() {
-        error!(status=?status, body=?body, "Pinecone chunk upsert failed");
-        return Err(format!("Pinecone chunk error: {status}").into());
+        error!(status=?status, body=?body, count = vectors.len(), "Pinecone upsert failed");
+        return Err(format!("Pinecone error: {status}").into());
     }
 
-    info!(chunk_id=?chunk.chunk_id, "Upserted chunk to Pinecone");
     Ok(())
 }
 
-pub async fn query_chunks_pinecone(cfg: &Config, embedding: Vec<f32>, top_k: usize, guild_id: Option<String>) -> Result<Vec<ChunkQueryResult>, DynErr> {
-    let url = format!("{}/query", cfg.pinecone_host);
-    let client = Client::new();
+fn chunk_vector(chunk: &MessageChunk, embedding: Vec<f32>) -> Vector<'_, ChunkMetadata<'_>> {
+    Vector {
+        id: Cow::Owned(format!("chunk_{}", chunk.chunk_id)),
+        values: embedding,
+        metadata: ChunkMetadata {
+            kind: "chunk",
+            chunk_id: &chunk.chunk_id,
+            guild_id: chunk.guild_id.as_deref(),
+            channel_id: &chunk.channel_id,
+            first_msg_id: &chunk.first_msg_id,
+            last_msg_id: &chunk.last_msg_id,
+            first_timestamp: &chunk.first_timestamp,
+            last_timestamp: &chunk.last_timestamp,
+            message_count: chunk.message_count,
+            authors: &chunk.authors,
+            full_text: &chunk.full_text,
+            has_summary: chunk.has_summary,
+            summary: chunk.summary.as_deref(),
+        },
+    }
+}
+
+#[derive(Serialize)]
+struct UpsertRequest<'a, M: Serialize> {
+    namespace: &'a str,
+    vectors: &'a [Vector<'a, M>],
+}
+
+#[derive(Serialize)]
+struct Vector<'a, M: Serialize> {
+    id: Cow<'a, str>,
+    values: Vec<f32>,
+    metadata: M,
+}
 
-    let mut query = json!({
+#[derive(Serialize)]
+struct MessageMetadata<'a> {
+    guild_id: Option<&'a str>,
+    channel_id: &'a str,
+    author_id: &'a str,
+    timestamp: &'a str,
+    text: &'a str,
+}
+
+#[derive(Serialize)]
+struct ChunkMetadata<'a> {
+    #[serde(rename = "type")]
+    kind: &'static str,
+    chunk_id: &'a str,
+    guild_id: Option<&'a str>,
+    channel_id: &'a str,
+    first_msg_id: &'a str,
+    last_msg_id: &'a str,
+    first_timestamp: &'a str,
+    last_timestamp: &'a str,
+    message_count: usize,
+    authors: &'a [String],
+    full_text: &'a str,
+    has_summary: bool,
+    // Only include summary if it exists (avoid null values)
+    #[serde(skip_serializing_if = "Option::is_none")]
+    summary: Option<&'a str>,
+}
+
+pub async fn query_chunks_pinecone(cfg: &Config, embedding: &[f32], top_k: usize, guild_id: Option<&str>) -> Result<Vec<ChunkQueryResult>, DynErr> {
+    let client = &*HTTP_CLIENT;
+
+    let query = json!({
         "namespace": cfg.namespace,
         "vector": embedding,
         "topK": top_k,
         "includeMetadata": true,
         "includeValues": false,
         "filter": {
-            "type": {"$eq": "chunk"}
+            "type": {"$eq": "chunk"},
+            "guild_id": guild_condition(guild_id)
         }
     });
 
-    // Add guild_id filter if provided
-    if let Some(guild_id) = guild_id {
-        query["filter"]["guild_id"] = json!({"$eq": guild_id});
-    } else {
-        // For DMs, filter for chunks without guild_id (null values)
-        query["filter"]["guild_id"] = json!({"$exists": false});
-    }
-
     let res = client
-        .post(&url)
+        .post(&cfg.pinecone_query_url)
         .header("Api-Key", &cfg.pinecone_key)
         .json(&query)
         .send()
         .await?;
 
     let status = res.status();
-    let body: serde_json::Value = res.json().await?;
-
     if !status.is_success() {
+        let body = res.text().await?;
         error!(status=?status, body=?body, "Pinecone chunk query failed");
         return Err(format!("Pinecone chunk query error: {status}").into());
     }
 
-    let empty_vec = vec![];
-    let matches = body["matches"].as_array().unwrap_or(&empty_vec);
-    let mut results = Vec::new();
-
-    for match_obj in matches {
-        let score = match_obj["score"].as_f64().unwrap_or(0.0);
-        let metadata = &match_obj["metadata"];
-
-        if let (
-            Some(chunk_id),
-            Some(full_text),
-            Some(first_timestamp),
-            Some(last_timestamp),
-            Some(message_count)
-        ) = (
-            metadata["chunk_id"].as_str(),
-            metadata["full_text"].as_str(),
-            metadata["first_timestamp"].as_str(),
-            metadata["last_timestamp"].as_str(),
-            metadata["message_count"].as_u64(),
-        ) {
-            let summary = metadata["summary"].as_str().map(|s| s.to_string());
-            let authors = metadata["authors"].as_array()
-                .map(|arr| arr.iter().filter_map(|v| v.as_str().map(|s| s.to_string())).collect())
-                .unwrap_or_else(Vec::new);
+    let body: QueryResponse<ChunkMatchMetadata> = res.json().await?;
+    let results: Vec<ChunkQueryResult> = body.matches
+        .into_iter()
+        .filter_map(|m| {
+            let metadata = m.metadata?;
+            let full_text = metadata.full_text?;
 
             // Use summary if available, otherwise use truncated full text
-            let text = if let Some(ref summary) = summary {
-                summary.clone()
-            } else {
-                if full_text.len() > 500 {
-                    format!("{}...", &full_text[..500])
-                } else {
-                    full_text.to_string()
-                }
+            let text = match metadata.summary {
+                Some(ref summary) => summary.clone(),
+                None if full_text.len() > 500 => format!("{}...", &full_text[..floor_char_boundary(&full_text, 500)]),
+                None => full_text,
             };
 
-            results.push(ChunkQueryResult {
-                chunk_id: chunk_id.to_string(),
+            Some(ChunkQueryResult {
+                chunk_id: metadata.chunk_id?,
                 text,
-                summary,
-                authors,
-                message_count: message_count as usize,
-                first_timestamp: first_timestamp.to_string(),
-                last_timestamp: last_timestamp.to_string(),
-                score,
-            });
-        }
-    }
+                summary: metadata.summary,
+                authors: metadata.authors,
+                message_count: metadata.message_count? as usize,
+                first_timestamp: metadata.first_timestamp?,
+                last_timestamp: metadata.last_timestamp?,
+                score: m.score,
+            })
+        })
+        .collect();
 
     info!(count = results.len(), "Found similar chunks");
     Ok(results)
 }
+
+// Match the guild's vectors, or for DMs (no guild) the vectors stored without a guild_id
+fn guild_condition(guild_id: Option<&str>) -> serde_json::Value {
+    match guild_id {
+        Some(guild_id) => json!({"$eq": guild_id}),
+        None => json!({"$exists": false}),
+    }
+}
+
+fn floor_char_boundary(text: &str, index: usize) -> usize {
+    (0..=index.min(text.len())).rev().find(|&i| text.is_char_boundary(i)).unwrap_or(0)
+}
+
+// Matches missing any of the required metadata are skipped
+
+#[derive(Deserialize)]
+struct QueryResponse<M> {
+    // Explicit default so the derive doesn't require M: Default
+    #[serde(default = "Vec::new")]
+    matches: Vec<Match<M>>,
+}
+
+#[derive(Deserialize)]
+struct Match<M> {
+    #[serde(default)]
+    score: f64,
+    metadata: Option<M>,
+}
+
+#[derive(Deserialize)]
+struct MessageMatchMetadata {
+    text: Option<String>,
+    author_id: Option<String>,
+    timestamp: Option<String>,
+}
+
+#[derive(Deserialize)]
+struct ChunkMatchMetadata {
+    chunk_id: Option<String>,
+    full_text: Option<String>,
+    first_timestamp: Option<String>,
+    last_timestamp: Option<String>,
+    // Pinecone returns metadata numbers as floats
+    message_count: Option<f64>,
+    summary: Option<String>,
+    #[serde(default)]
+    authors: Vec<String>,
+}
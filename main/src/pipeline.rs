@@ -0,0 +1,96 @@
+use std::sync::{Arc, Mutex};
+use std::time::Duration;
+use tokio::sync::mpsc;
+use tokio::time::{timeout_at, Instant};
+use tracing::{info, error};
+use crate::{
+    config::Config,
+    schema::MessageEvent,
+    cohere::get_embeddings,
+    pinecone::upsert_messages_to_pinecone,
+    cache::GuildVersions,
+};
+
+const QUEUE_CAPACITY: usize = 2048;
+const BATCH_SIZE: usize = 32;
+const BATCH_WAIT: Duration = Duration::from_millis(100);
+// Embedded batches waiting on the Pinecone writer
+const WRITE_QUEUE_CAPACITY: usize = 8;
+
+/// Two-stage pipeline for individual messages: an embed stage batches queued messages into
+/// one Cohere call, and a writer stage upserts each embedded batch to Pinecone, so the next
+/// batch is being embedded while the previous one is written.
+#[derive(Clone)]
+pub struct EmbedPipeline {
+    sender: mpsc::Sender<MessageEvent>,
+}
+
+impl EmbedPipeline {
+    /// Start the pipeline; when `versions` is given, each message's guild is bumped once
+    /// its vector has been upserted and is searchable.
+    pub fn spawn(cfg: Arc<Config>, versions: Option<Arc<Mutex<GuildVersions>>>) -> Self {
+        let (sender, receiver) = mpsc::channel(QUEUE_CAPACITY);
+        let (write_sender, write_receiver) = mpsc::channel(WRITE_QUEUE_CAPACITY);
+        tokio::spawn(embed_stage(cfg.clone(), receiver, write_sender));
+        tokio::spawn(write_stage(cfg, write_receiver, versions));
+        Self { sender }
+    }
+
+    /// Queue a message for indexing; waits if the pipeline is saturated.
+    pub async fn submit(&self, event: MessageEvent) {
+        if self.sender.send(event).await.is_err() {
+            error!("Embedding pipeline has shut down, dropping message");
+        }
+    }
+}
+
+async fn embed_stage(
+    cfg: Arc<Config>,
+    mut receiver: mpsc::Receiver<MessageEvent>,
+    write_sender: mpsc::Sender<(Vec<MessageEvent>, Vec<Vec<f32>>)>,
+) {
+    while let Some(event) = receiver.recv().await {
+        // Collect up to BATCH_SIZE messages, waiting at most BATCH_WAIT after the first
+        let mut batch = Vec::with_capacity(BATCH_SIZE);
+        batch.push(event);
+        let deadline = Instant::now() + BATCH_WAIT;
+        while batch.len() < BATCH_SIZE {
+            match timeout_at(deadline, receiver.recv()).await {
+                Ok(Some(event)) => batch.push(event),
+                _ => break,
+            }
+        }
+
+        let texts: Vec<&str> = batch.iter().map(|event| event.text.as_str()).collect();
+        match get_embeddings(&cfg, &texts).await {
+            Ok(embeddings) => {
+                if write_sender.send((batch, embeddings)).await.is_err() {
+                    error!("Pinecone writer has shut down");
+                    return;
+                }
+            }
+            Err(err) => error!(count = batch.len(), error = %err, "Individual message embedding failed"),
+        }
+    }
+}
+
+async fn write_stage(
+    cfg: Arc<Config>,
+    mut receiver: mpsc::Receiver<(Vec<MessageEvent>, Vec<Vec<f32>>)>,
+    versions: Option<Arc<Mutex<GuildVersions>>>,
+) {
+    while let Some((batch, embeddings)) = receiver.recv().await {
+        match upsert_messages_to_pinecone(&cfg, &batch, embeddings).await {
+            Ok(()) => {
+                info!(count = batch.len(), "Indexed individual messages");
+                if let Some(ref versions) = versions {
+                    let mut versions = versions.lock().unwrap();
+                    for event in &batch {
+                        versions.bump(&event.guild_id);
+                    }
+                }
+            }
+            Err(err) => error!(count = batch.len(), error = %err, "Failed to upsert individual messages"),
+        }
+    }
+}
@@ -0,0 +1,74 @@
+use std::convert::Infallible;
+use std::sync::Arc;
+use warp::Filter;
+use crate::{config::Config, health::HealthChecker, metrics::MetricsRegistry};
+
+/// `/metrics`, `/health` and a root banner; every service exposes the same routes.
+pub fn routes(
+    banner: &'static str,
+    metrics_registry: Arc<MetricsRegistry>,
+    health_checker: Arc<HealthChecker>,
+    cfg: Config,
+) -> impl Filter<Extract = (impl warp::Reply,), Error = warp::Rejection> + Clone {
+    let metrics_route = warp::path("metrics")
+        .and(warp::get())
+        .and(with_metrics(metrics_registry))
+        .and_then(handle_metrics);
+
+    let health_route = warp::path("health")
+        .and(warp::get())
+        .and(with_health_checker(health_checker))
+        .and(with_config(cfg))
+        .and_then(handle_health);
+
+    let root_route = warp::path::end()
+        .and(warp::get())
+        .map(move || banner);
+
+    metrics_route.or(health_route).or(root_route)
+}
+
+fn with_metrics(
+    metrics: Arc<MetricsRegistry>,
+) -> impl Filter<Extract = (Arc<MetricsRegistry>,), Error = Infallible> + Clone {
+    warp::any().map(move || metrics.clone())
+}
+
+fn with_health_checker(
+    health_checker: Arc<HealthChecker>,
+) -> impl Filter<Extract = (Arc<HealthChecker>,), Error = Infallible> + Clone {
+    warp::any().map(move || health_checker.clone())
+}
+
+fn with_config(
+    config: Config,
+) -> impl Filter<Extract = (Config,), Error = Infallible> + Clone {
+    warp::any().map(move || config.clone())
+}
+
+async fn handle_metrics(metrics: Arc<MetricsRegistry>) -> Result<impl warp::Reply, warp::Rejection> {
+    let metrics_text = metrics.gather_metrics();
+    Ok(warp::reply::with_header(
+        metrics_text,
+        "Content-Type",
+        "text/plain; version=0.0.4; charset=utf-8",
+    ))
+}
+
+async fn handle_health(
+    health_checker: Arc<HealthChecker>,
+    config: Config,
+) -> Result<impl warp::Reply, warp::Rejection> {
+    let health_status = health_checker
+        .get_overall_health(&config.elasticsearch_url, &config.pinecone_host)
+        .await;
+
+    let json_response = serde_json::to_string_pretty(&health_status)
+        .unwrap_or_else(|_| "{\"error\": \"Failed to serialize health status\"}".to_string());
+
+    Ok(warp::reply::with_header(
+        json_response,
+        "Content-Type",
+        "application/json",
+    ))
+}